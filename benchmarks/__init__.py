@@ -0,0 +1,7 @@
+"""
+Benchmarks for the papup encode and decode stages.
+
+Run them from the repository root, e.g.:
+
+    python -m benchmarks.bench_paper
+"""
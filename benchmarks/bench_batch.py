@@ -0,0 +1,54 @@
+"""
+Benchmark of batch printing: a fresh papup encode process per file against
+encode_batch's warm worker pool, for a directory of small files of mixed
+sizes.
+"""
+
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from papup.batch import encode_batch  # noqa: E402
+
+
+def make_files(directory, count):
+    with open(os.path.join(ROOT, "papup", "faust1.txt"), "rb") as f:
+        text = f.read()
+    for n in range(count):
+        # sizes from 1 KB to 64 KB, with a large file in every 8
+        size = 64 * 1024 if n % 8 == 0 else 1024 * (1 + n % 8)
+        with open(os.path.join(directory, "file{:03d}.txt".format(n)), "wb") as f:
+            f.write(text[n * 100:n * 100 + size])
+
+
+def main(count=16, processes=None, qr=False):
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "in")
+        os.mkdir(source)
+        make_files(source, count)
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        extra = ["--qr"] if qr else []
+        t0 = time.perf_counter()
+        for name in sorted(os.listdir(source)):
+            subprocess.run([sys.executable, "-m", "papup", "encode", os.path.join(source, name),
+                            "-o", os.path.join(tmp, name + ".pdf")] + extra,
+                           env=env, check=True, stdout=subprocess.DEVNULL)
+        cold = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            done = list(encode_batch([source], tmp, processes, qr=qr))
+        warm = time.perf_counter() - t0
+        print("{} files{}".format(count, " (QR)" if qr else ""))
+        print("process per file {:8.3f} s {:8.2f} files/s".format(cold, count / cold))
+        print("encode_batch     {:8.3f} s {:8.2f} files/s".format(warm, len(done) / warm))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:2]], qr="--qr" in sys.argv)
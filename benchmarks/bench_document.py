@@ -0,0 +1,48 @@
+"""
+Benchmark of PapupDocument.render with QR codes drawn as vector paths
+against QR codes embedded as inline images: render time and PDF size,
+and of the serial render against render_parallel. Checks that the vector
+mode gives the smaller PDF.
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from papup.papup_document import PapupDocument  # noqa: E402
+from papup.papup_file import PapupFile  # noqa: E402
+
+
+def main(size_kb=16, processes=1):
+    pu = PapupFile("bench.bin", os.urandom(int(size_kb * 1024)))
+    pu.mime = ("application/octet-stream", None)
+    pu.description = "benchmark"
+    print("{} QR parts, {} worker processes".format(pu.part_count, processes))
+    sizes = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in PapupDocument.QR_MODES:
+            name = os.path.join(tmp, mode + ".pdf")
+            doc = PapupDocument(pu, file_name=name, qr_mode=mode)
+            t0 = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                doc.render(processes=processes)
+            dt = time.perf_counter() - t0
+            sizes[mode] = os.path.getsize(name)
+            print("{:<8} {:8.3f} s {:10d} bytes".format(mode, dt, sizes[mode]))
+        assert sizes["vector"] < sizes["image"], sizes
+        name = os.path.join(tmp, "parallel.pdf")
+        doc = PapupDocument(pu, file_name=name)
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            doc.render_parallel(processes=processes)
+        dt = time.perf_counter() - t0
+        print("{:<8} {:8.3f} s {:10d} bytes".format("parallel", dt, os.path.getsize(name)))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:3]])
@@ -0,0 +1,50 @@
+"""
+Benchmark of multi-stream compression: every method as a single stream
+against independent streams compressed and decompressed in a process pool,
+for packed size (the cost of the cut between streams) and speed.
+
+    python -m benchmarks.bench_multi_stream [SIZE_MB [PROCESSES]]
+"""
+
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.bench_payload import round_trip  # noqa: E402
+from papup.payload import COMPRESSION_METHODS, MULTI_STREAM_BLOCK_SIZES  # noqa: E402
+
+
+def make_text(size):
+    """Lines of faust1.txt in random order, not one text repeated over and over."""
+    with open(os.path.join(ROOT, "papup", "faust1.txt"), "rb") as f:
+        lines = f.read().splitlines(keepends=True)
+    rnd = random.Random(size)
+    out = bytearray()
+    while len(out) < size:
+        out += rnd.choice(lines)
+    return bytes(out[:size])
+
+
+def main(size_mb=16.0, processes=None):
+    size = int(size_mb * 1e6)
+    content = make_text(size)
+    print("{} MB text, {} processes".format(size_mb, processes or os.cpu_count()))
+    print("{:<6} {:<7} {:>7} {:>10} {:>7} {:>10} {:>10}".format(
+        "method", "streams", "block", "packed", "ratio", "pack MB/s", "unpack MB/s"))
+    for method in MULTI_STREAM_BLOCK_SIZES:
+        single = None
+        for multi_stream in (False, True):
+            _, packed, t_pack, t_unpack = round_trip(
+                content, processes, compression=method, multi_stream=multi_stream)
+            single = single or len(packed)
+            print("{:<6} {:<7} {:>7} {:>10} {:>7.4f} {:>10.2f} {:>10.2f}".format(
+                COMPRESSION_METHODS[method], "multi" if multi_stream else "single",
+                MULTI_STREAM_BLOCK_SIZES[method] // 1000 if multi_stream else "-",
+                len(packed), len(packed) / single, size / t_pack / 1e6, size / t_unpack / 1e6))
+
+
+if __name__ == "__main__":
+    main(*[float(a) for a in sys.argv[1:2]], *[int(a) for a in sys.argv[2:3]])
@@ -0,0 +1,92 @@
+"""
+Benchmark for the block grid rasterizer of paper.PapupPage.
+
+Compares pages/second of the former per pixel renderer (putpixel for every
+block, paste into the page, grid drawn line by line) with the current bulk
+rasterizer and checks that both produce identical images.
+"""
+
+import os
+import sys
+import time
+import uuid
+
+import PIL.Image
+import PIL.ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from papup.paper import PapupPage, get_logo  # noqa: E402
+
+
+def legacy_page_image(page):
+    """The page renderer as it was before the bulk rasterizer."""
+    total_data = page.generate_page_header() + page.data
+    block_images = []
+    for block in page.iterate_blocks(total_data):
+        im = PIL.Image.new("1", (page.BLOCK_WIDTH, page.BLOCK_WIDTH), "white")
+        for y in range(page.BLOCK_WIDTH):
+            for x in range(page.BLOCK_WIDTH // 8):
+                b = block[y * (page.BLOCK_WIDTH // 8) + x]
+                for bn in range(8):
+                    if (0x80 >> bn) & b:
+                        im.putpixel((x * 8 + bn, y), 0x0)
+        block_images.append(im)
+    iw = page.cols * (page.BLOCK_WIDTH + 3) + 1 + 2 * 4
+    ih = page.actual_rows * (page.BLOCK_WIDTH + 3) + 1 + 2 * 4
+    im = PIL.Image.new("1", (iw, ih), "white")
+    for n, block in enumerate(block_images):
+        bx = (n + 1) % page.cols
+        by = (n + 1) // page.cols
+        x = bx * (page.BLOCK_WIDTH + 3) + 4
+        y = by * (page.BLOCK_WIDTH + 3) + 4
+        im.paste(block, (x + 2, y + 2))
+    draw = PIL.ImageDraw.Draw(im)
+    for x in range(page.cols + 1):
+        xx = x * (page.BLOCK_WIDTH + 3) + 4
+        draw.line((xx, 0, xx, im.size[1]), "black")
+    for y in range(page.actual_rows + 1):
+        yy = y * (page.BLOCK_WIDTH + 3) + 4
+        draw.line((0, yy, im.size[0], yy), "black")
+    im.paste(get_logo(), (5, 5))
+    return im
+
+
+def make_pages(count, cols=15, rows=20):
+    file_id = uuid.uuid4()
+    pages = []
+    for n in range(count):
+        space = (cols * rows - 1) * PapupPage.BLOCK_PAYLOAD - PapupPage.PAGE_HEADER_SIZE
+        if n == count - 1:
+            # last page is only partially filled
+            space = space // 3
+        page = PapupPage(n, os.urandom(space), cols, rows)
+        page.file_id = file_id
+        page.total_pages = count
+        pages.append(page)
+    return pages
+
+
+def bench(name, render, pages):
+    t0 = time.perf_counter()
+    for page in pages:
+        render(page)
+    dt = time.perf_counter() - t0
+    print("{:<10} {:6d} pages {:8.3f} s {:10.1f} pages/s".format(name, len(pages), dt, len(pages) / dt))
+    return dt
+
+
+def main(count=20):
+    pages = make_pages(count)
+    # identical output:
+    for page in pages:
+        page.generate_page_image()
+        assert page.page_image.tobytes() == legacy_page_image(page).tobytes()
+    print("output identical for {} pages".format(len(pages)))
+    before = bench("legacy", legacy_page_image, pages)
+    after = bench("bulk", PapupPage.generate_page_image, pages)
+    print("speedup: {:.1f}x".format(before / after))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,68 @@
+"""
+Throughput benchmark of PapupPayload packing against unpacking, for
+compressible and incompressible content at several redundancy levels.
+"""
+
+import contextlib
+import hashlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from papup.g2 import PapupFile  # noqa: E402
+from papup.payload import COMPRESSION_METHODS, PapupPayload  # noqa: E402
+
+
+def make_content(size, compressible):
+    if not compressible:
+        return os.urandom(size)
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "papup", "faust1.txt"), "rb") as f:
+        text = f.read()
+    return (text * (size // len(text) + 1))[:size]
+
+
+def round_trip(content, processes=None, **kwargs):
+    """Pack and unpack content, returns the payload, pack and unpack seconds."""
+    pl = PapupPayload(**kwargs)
+    out = io.BytesIO()
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        pl.pack_to(out, content, processes)
+    t_pack = time.perf_counter() - t0
+    packed = out.getvalue()
+    restored = io.BytesIO()
+    t0 = time.perf_counter()
+    PapupPayload().unpack_to(restored, packed, sha1=hashlib.sha1(content).hexdigest(), processes=processes)
+    t_unpack = time.perf_counter() - t0
+    assert restored.getvalue() == content
+    return pl, packed, t_pack, t_unpack
+
+
+def main(size_mb=1.0):
+    size = int(size_mb * 1e6)
+    print("{:<8} {:>3} {:>10} {:>10} {:>10}".format("content", "red", "packed", "pack MB/s", "unpack MB/s"))
+    for compressible in (True, False):
+        content = make_content(size, compressible)
+        for redundancy in (0, 1, 3, 5):
+            _, packed, t_pack, t_unpack = round_trip(content, redundancy=redundancy)
+            print("{:<8} {:>3} {:>10} {:>10.2f} {:>10.2f}".format(
+                "text" if compressible else "random", redundancy, len(packed),
+                size / t_pack / 1e6, size / t_unpack / 1e6))
+    print()
+    print("{:<8} {:<10} {:>10} {:>6} {:>10} {:>10}".format(
+        "content", "method", "packed", "pages", "pack MB/s", "unpack MB/s"))
+    for compressible in (True, False):
+        content = make_content(size, compressible)
+        for method in list(COMPRESSION_METHODS) + ["auto"]:
+            pl, packed, t_pack, t_unpack = round_trip(content, compression=method, count_pages=PapupFile.pages_for)
+            name = COMPRESSION_METHODS[pl.compression]
+            print("{:<8} {:<10} {:>10} {:>6} {:>10.2f} {:>10.2f}".format(
+                "text" if compressible else "random", name if method != "auto" else "auto:" + name,
+                len(packed), PapupFile.pages_for(len(packed)), size / t_pack / 1e6, size / t_unpack / 1e6))
+
+
+if __name__ == "__main__":
+    main(*[float(a) for a in sys.argv[1:2]])
@@ -0,0 +1,39 @@
+"""
+Benchmark of pdf.build_pdf: the platypus backend (PNG per page, laid out by
+reportlab) against the direct backend (1-bit Flate images written as is).
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from papup.pdf import build_pdf  # noqa: E402
+
+from benchmarks.bench_paper import make_pages  # noqa: E402
+
+
+class PageFile():
+    def __init__(self, pages):
+        self.pages = pages
+
+
+def main(count=20):
+    pages = make_pages(count)
+    for page in pages:
+        page.generate_page_legend()
+        page.generate_page_image()
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in ("platypus", "direct"):
+            name = os.path.join(tmp, backend + ".pdf")
+            t0 = time.perf_counter()
+            build_pdf(PageFile(pages), name, backend=backend)
+            dt = time.perf_counter() - t0
+            print("{:<10} {:6d} pages {:8.3f} s {:10d} bytes".format(
+                backend, len(pages), dt, os.path.getsize(name)))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
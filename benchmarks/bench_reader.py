@@ -0,0 +1,55 @@
+"""
+Benchmark of paper_reader.read_page_image on synthetic scans of full
+paper.PapupPage pages: the page image scaled to the scan resolution,
+blurred and saved as JPEG. Checks the data read back.
+"""
+
+import io
+import os
+import sys
+import time
+
+import PIL.Image
+import PIL.ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from papup.paper_reader import PAGE_WIDTH, read_page_image  # noqa: E402
+
+from benchmarks.bench_paper import make_pages  # noqa: E402
+
+
+def synthetic_scan(page, dpi=600):
+    """Greyscale JPEG of page printed at one point per bit and scanned at dpi."""
+    scale = dpi / 72
+    img = PIL.Image.new("L", (round(PAGE_WIDTH * scale), round(842 * scale)), 255)
+    image = page.page_image.convert("L")
+    img.paste(image.resize((round(image.width * scale), round(image.height * scale)), PIL.Image.NEAREST),
+              (round(30 * scale), round(60 * scale)))
+    img = img.filter(PIL.ImageFilter.GaussianBlur(scale / 3))
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=80)
+    scan = PIL.Image.open(out)
+    scan.load()
+    return scan
+
+
+def main(count=5, dpi=600):
+    pages = make_pages(count)
+    for page in pages:
+        page.generate_page_image()
+    scans = [synthetic_scan(page, dpi) for page in pages]
+    total = 0
+    for page, scan in zip(pages, scans):
+        t0 = time.perf_counter()
+        read = read_page_image(scan)
+        dt = time.perf_counter() - t0
+        total += dt
+        assert read.data[:len(page.data)] == bytes(page.data)
+        print("page {} {}x{}: {:.3f} s, {} bad blocks".format(
+            read.page_number + 1, scan.width, scan.height, dt, len(read.bad_blocks)))
+    print("{} dpi: {:.2f} pages/s".format(dpi, len(pages) / total))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:3]])
@@ -0,0 +1,51 @@
+"""
+Benchmark for the Reed-Solomon layer: encode, decode of a clean buffer and
+decode with a share of damaged codewords, compared to a plain copy.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from papup.reedsolomon import get_codec  # noqa: E402
+
+
+def timed(f, *args, **kwargs):
+    t0 = time.perf_counter()
+    r = f(*args, **kwargs)
+    return time.perf_counter() - t0, r
+
+
+def report(name, size, dt):
+    print("{:<24} {:8.3f} s {:8.2f} MB/s".format(name, dt, size / dt / 1e6))
+
+
+def main(size_mb=2, damaged_percent=1, n=255, k=223):
+    codec = get_codec(n, k)
+    data = os.urandom(int(size_mb * 1e6) // k * k)
+    size = len(data)
+    dt, _ = timed(bytearray, data)
+    report("memcpy", size, dt)
+    dt, encoded = timed(codec.encode, data)
+    report("encode RS({},{})".format(n, k), size, dt)
+    dt, (decoded, rs_report) = timed(codec.decode, encoded)
+    assert decoded == data
+    report("decode clean", size, dt)
+    damaged = bytearray(encoded)
+    codewords = len(encoded) // n
+    random.seed(0)
+    for cw in random.sample(range(codewords), int(codewords * damaged_percent / 100)):
+        for p in random.sample(range(n), (n - k) // 2):
+            damaged[cw * n + p] ^= random.randint(1, 255)
+    for processes in sorted({1, os.cpu_count() or 1}):
+        dt, (decoded, rs_report) = timed(codec.decode, damaged, processes=processes)
+        assert decoded == data
+        report("decode {}% damaged, {}p".format(damaged_percent, processes), size, dt)
+    print(rs_report)
+
+
+if __name__ == "__main__":
+    main(*[float(a) for a in sys.argv[1:3]])
@@ -0,0 +1,74 @@
+"""
+Benchmark of page scanning: pyzbar on the full page (Scanner.scan_batch)
+against reduced, binarized pages decoded cell by cell (Scanner.scan_tiled).
+Reports pages/second and the share of QR codes decoded.
+
+The pages are synthetic 600 dpi JPEG "scans", drawn straight from the
+PapupLayout of a document. Needs the zbar library for pyzbar.
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import PIL.Image
+import PIL.ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reportlab.lib.pagesizes import A4  # noqa: E402
+
+from papup.papup_document import PapupDocument, get_font_height, make_qr_matrix, qr_matrix_image  # noqa: E402
+from papup.papup_file import PapupFile  # noqa: E402
+
+
+def synthetic_scan(doc, page, dpi=600):
+    """Greyscale image of page of doc as a scanner would deliver it."""
+    layout = doc.get_layout()
+    scale = dpi / 72
+    img = PIL.Image.new("L", (round(A4[0] * scale), round(A4[1] * scale)), 255)
+    size = round(layout.qw * scale)
+    font_height = get_font_height("Courier", 7)
+    for n in layout.page_items(page):
+        _, x, y = layout.position(n)
+        data, title = layout.qr_item(n)
+        qr = qr_matrix_image(make_qr_matrix(data)).convert("L").resize((size, size), PIL.Image.NEAREST)
+        # grey bar where the title is printed
+        img.paste(128, (round(x * scale), round((A4[1] - y + 1) * scale),
+                        round((x + layout.qw / 2) * scale), round((A4[1] - y + font_height) * scale)))
+        img.paste(qr, (round(x * scale), round((A4[1] - y + font_height * 1.8) * scale)))
+    return img.filter(PIL.ImageFilter.GaussianBlur(1.5))
+
+
+def main(size_kb=8, processes=1):
+    from papup.q2 import Scanner
+    try:
+        import pyzbar.pyzbar  # noqa: F401
+    except ImportError as e:
+        print("skipped, pyzbar not available: {}".format(e))
+        return
+    pu = PapupFile("bench.bin", os.urandom(int(size_kb * 1024)))
+    pu.mime = ("application/octet-stream", None)
+    doc = PapupDocument(pu, file_name=io.BytesIO())
+    layout = doc.get_layout()
+    with tempfile.TemporaryDirectory() as tmp:
+        for page in range(1, layout.pages + 1):
+            synthetic_scan(doc, page).save(os.path.join(tmp, "page{:03d}.jpg".format(page)),
+                                           quality=85, dpi=(600, 600))
+        print("{} pages, {} QR codes, {} worker processes".format(layout.pages, layout.total, processes))
+        for name in ("scan_batch", "scan_tiled"):
+            scanner = Scanner()
+            t0 = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                scans = getattr(scanner, name)(tmp, processes=processes)
+            dt = time.perf_counter() - t0
+            found = len({code for scan in scans for code in scan.codes})
+            print("{:<12} {:8.3f} s {:8.2f} pages/s {:6.1%} decoded".format(
+                name, dt, layout.pages / dt, found / layout.total))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:3]])
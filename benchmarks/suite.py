@@ -0,0 +1,263 @@
+"""
+End-to-end benchmark suite: runs every stage of encoding, rendering,
+scanning and restoring over a synthetic corpus of sizes and content kinds
+and writes the results as JSON, to track regressions between releases.
+
+Every job runs in a fresh process, so the peak RSS reported is that of the
+job alone (input setup included, rss_before_kb is the level the stage
+started at). Stages needing pyzbar are skipped when zbar is not available.
+Every result has the papup.metrics stage breakdown of its job, optionally
+with a cProfile summary (--profile) and the tracemalloc peak
+(--trace-memory).
+
+    python -m benchmarks.suite --sizes 16384,1048576 --out results.json
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+STAGES = ("pack", "page_images", "build_pdf", "render", "scan", "restore")
+# stages working on QR documents, only run up to --qr-max-size
+QR_STAGES = ("render", "scan", "restore")
+CONTENT_KINDS = ("text", "random", "mixed")
+DEFAULT_SIZES = (16 * 1024, 256 * 1024, 1024 * 1024)
+# redundancy used by the stages after pack
+DEFAULT_REDUNDANCY = 3
+
+
+class StageSkipped(Exception):
+    pass
+
+
+def make_content(size, kind):
+    """Deterministic content: repeated text, random bytes or half of each."""
+    if kind == "random":
+        return random.Random(size).randbytes(size)
+    with open(os.path.join(ROOT, "papup", "faust1.txt"), "rb") as f:
+        text = f.read()
+    if kind == "text":
+        return (text * (size // len(text) + 1))[:size]
+    half = size // 2
+    return make_content(half, "text") + make_content(size - half, "random")
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def packed_payload(content, redundancy=DEFAULT_REDUNDANCY):
+    from papup.payload import PapupPayload
+    pl = PapupPayload(redundancy=redundancy)
+    pl.set_content(content)
+    pl.pack_payload()
+    return pl.data
+
+
+def qr_document(content, file_name):
+    from papup.papup_document import PapupDocument
+    from papup.papup_file import PapupFile
+    pu = PapupFile("bench.bin", content)
+    pu.mime = ("application/octet-stream", None)
+    pu.description = "benchmark"
+    return PapupDocument(pu, file_name=file_name)
+
+
+def import_scanner():
+    from papup import q2
+    try:
+        import pyzbar.pyzbar  # noqa: F401
+    except ImportError as e:
+        raise StageSkipped("pyzbar not available: {}".format(e))
+    return q2
+
+
+# every stage function prepares its input, then runs timed() on the stage
+# and returns the metrics; timed() records time and memory around it
+
+def stage_pack(job, timed):
+    from papup.payload import PapupPayload
+    content = make_content(job["size"], job["content"])
+    pl = PapupPayload(redundancy=job["redundancy"])
+    pl.set_content(content)
+    timed(pl.pack_payload)
+    return {"bytes_out": len(pl.data)}
+
+
+def stage_page_images(job, timed):
+    from papup.g2 import PapupFile
+    pf = PapupFile(packed_payload(make_content(job["size"], job["content"])))
+
+    def render():
+        for page in pf.iter_page_images():
+            pass
+    timed(render)
+    return {"pages": pf.page_count}
+
+
+def stage_build_pdf(job, timed):
+    from papup.g2 import PapupFile
+    from papup.pdf import build_pdf
+    pf = PapupFile(packed_payload(make_content(job["size"], job["content"])))
+    pf.cut_pages()
+    pf.generate_page_images()
+    with tempfile.TemporaryDirectory() as tmp:
+        name = os.path.join(tmp, "out.pdf")
+        timed(build_pdf, pf, name)
+        return {"pages": len(pf.pages), "bytes_out": os.path.getsize(name)}
+
+
+def stage_render(job, timed):
+    with tempfile.TemporaryDirectory() as tmp:
+        name = os.path.join(tmp, "out.pdf")
+        doc = qr_document(make_content(job["size"], job["content"]), name)
+        timed(doc.render, processes=job["processes"])
+        return {"pages": doc.get_layout().pages, "qr_codes": doc.get_layout().total,
+                "bytes_out": os.path.getsize(name)}
+
+
+def stage_scan(job, timed):
+    q2 = import_scanner()
+    from benchmarks.bench_scan import synthetic_scan
+    doc = qr_document(make_content(job["size"], job["content"]), io.BytesIO())
+    layout = doc.get_layout()
+    scans = [synthetic_scan(doc, page) for page in range(1, layout.pages + 1)]
+    scanner = q2.Scanner()
+
+    def scan():
+        for img in scans:
+            scanner.scan(img)
+    timed(scan)
+    found = sum(len(p.pum) + p.pud_count - len(p.missing_parts()) for p in scanner.store.values())
+    return {"pages": layout.pages, "qr_codes": layout.total, "qr_codes_read": found}
+
+
+def stage_restore(job, timed):
+    # only parses codes, needs no zbar
+    from papup import q2
+    content = make_content(job["size"], job["content"])
+    doc = qr_document(content, io.BytesIO())
+    layout = doc.get_layout()
+    codes = [layout.qr_item(n)[0] for n in range(layout.total)]
+    scanner = q2.Scanner()
+
+    def restore():
+        for code in codes:
+            scanner.read_code(code)
+        return scanner.store[doc.pu.ident].get_data()
+    data = timed(restore)
+    if data != content:
+        raise ValueError("Restored data does not match")
+    return {"pages": layout.pages, "qr_codes": layout.total, "bytes_out": len(data)}
+
+
+def run_job(job):
+    """Run a single job, meant to be the only job of its process."""
+    from papup import metrics
+    result = dict(job)
+    measured = {}
+
+    def timed(f, *args, **kwargs):
+        measured["rss_before_kb"] = peak_rss_kb()
+        with metrics.collect(job["profile"], job["trace_memory"]) as m:
+            r = f(*args, **kwargs)
+        measured["seconds"] = m.seconds
+        measured["peak_rss_kb"] = peak_rss_kb()
+        measured["metrics"] = m.as_dict()
+        return r
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result.update(globals()["stage_" + job["stage"]](job, timed))
+    except StageSkipped as e:
+        result["skipped"] = str(e)
+        return result
+    result.update(measured)
+    mb = job["size"] / 1e6
+    result["mb_per_s"] = mb / measured["seconds"]
+    if "pages" in result:
+        result["pages_per_mb"] = result["pages"] / mb
+        result["pages_per_s"] = result["pages"] / measured["seconds"]
+    return result
+
+
+def iter_jobs(stages, sizes, kinds, redundancies, qr_max_size, processes, profile=False, trace_memory=False):
+    for stage in stages:
+        for size in sizes:
+            if stage in QR_STAGES and size > qr_max_size:
+                continue
+            for kind in kinds:
+                for redundancy in (redundancies if stage == "pack" else [DEFAULT_REDUNDANCY]):
+                    yield {"stage": stage, "size": size, "content": kind,
+                           "redundancy": redundancy, "processes": processes,
+                           "profile": profile, "trace_memory": trace_memory}
+
+
+def main(argv=None):
+    from papup.payload import REDUNDANCY_CODES
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--stages", default=",".join(STAGES))
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES))
+    parser.add_argument("--content", default=",".join(CONTENT_KINDS))
+    parser.add_argument("--redundancy", default=",".join(str(r) for r in sorted(REDUNDANCY_CODES)),
+                        help="redundancy levels for the pack stage")
+    parser.add_argument("--qr-max-size", type=int, default=16 * 1024,
+                        help="largest size the QR document stages are run for")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes used inside a stage")
+    parser.add_argument("--profile", action="store_true",
+                        help="run the stages under cProfile and report the top functions")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="report the peak of python allocations (tracemalloc)")
+    parser.add_argument("--out", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+    stages = args.stages.split(",")
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error("unknown stage: {}".format(stage))
+    jobs = list(iter_jobs(stages, [int(s) for s in args.sizes.split(",")], args.content.split(","),
+                          [int(r) for r in args.redundancy.split(",")], args.qr_max_size, args.processes,
+                          args.profile, args.trace_memory))
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for job in jobs:
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as pool:
+            result = pool.submit(run_job, job).result()
+        results.append(result)
+        if "skipped" in result:
+            status = "skipped: " + result["skipped"]
+        else:
+            status = "{:8.3f} s {:8.3f} MB/s {:8d} KB peak".format(
+                result["seconds"], result["mb_per_s"], result["peak_rss_kb"])
+        print("{:<12} {:>8} {:<7} r{} {}".format(
+            job["stage"], job["size"], job["content"], job["redundancy"], status), file=sys.stderr)
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
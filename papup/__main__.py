@@ -0,0 +1,5 @@
+import sys
+
+from papup.cli import main
+
+sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Printing many files, one PDF each, in a pool of worker processes that load
+fonts, logo, RS tables and the QR code library once and keep them warm for
+every file they are handed.
+"""
+
+import concurrent.futures
+import os
+
+
+def encode_printout(source, out, qr=False, redundancy=3, encoding="hex", qr_mode="image",
+                    description=None, compression=1, compression_level=None, compression_budget=None,
+                    multi_stream=False, processes=None):
+    """
+    Print file source into PDF out, as block grid pages or, with qr, as QR
+    codes. The compression arguments are those of PapupPayload, for block
+    grid pages. processes are worker processes computing QR codes, or
+    threads compressing block grid pages and worker processes compressing
+    their payload's streams. Returns the number of pages.
+    """
+    if qr:
+        from papup.papup_document import PapupDocument
+        from papup.papup_file import PapupFile
+        pu = PapupFile.map(source)
+        pu.set_encoding(encoding)
+        if description:
+            pu.description = description
+        doc = PapupDocument(pu, file_name=out, qr_mode=qr_mode)
+        doc.render(processes=processes)
+        return doc.get_layout().pages
+    from papup.g2 import encode_file
+    from papup.payload import PapupPayload
+    pl = PapupPayload(redundancy=redundancy, compression=compression, compression_level=compression_level,
+                      compression_budget=compression_budget, multi_stream=multi_stream)
+    return encode_file(source, out, pl, processes, processes)
+
+
+def warm_up(options):
+    """Load everything encode_printout(**options) needs once, for a worker process."""
+    from papup.payload import REDUNDANCY_CODES
+    from papup.reedsolomon import get_codec
+    # payload header, page header and payload codes
+    get_codec(32, 14)
+    get_codec(64, 34)
+    code = REDUNDANCY_CODES.get(options.get("redundancy", 3))
+    if code is not None:
+        get_codec(*code)
+    if options.get("qr"):
+        from papup.papup_document import get_font_height, get_logo, make_qr_matrix
+        get_logo()
+        for font_name in ("Courier", "Courier-Bold"):
+            get_font_height(font_name, 7)
+        make_qr_matrix("PUD")
+    else:
+        from papup.paper import get_logo
+        get_logo()
+
+
+def iter_batch_files(sources):
+    """Files to print: file names and the files in directories (not recursive)."""
+    for source in sources:
+        if os.path.isdir(source):
+            for name in sorted(os.listdir(source)):
+                path = os.path.join(source, name)
+                if os.path.isfile(path):
+                    yield path
+        else:
+            yield source
+
+
+def encode_batch(sources, out_dir=".", processes=None, **options):
+    """
+    Print every file of sources (see iter_batch_files) into its own PDF
+    FILE.pdf in out_dir, in a pool of processes warm worker processes
+    (default: one per CPU). Files are handed out largest first, so a huge
+    file does not start last and keep the batch waiting for it alone.
+    Yields (source, pdf name, pages) as files are done, pages is None for
+    files that failed.
+    """
+    files = sorted(iter_batch_files(sources), key=os.path.getsize, reverse=True)
+    outs = [os.path.join(out_dir, os.path.basename(f) + ".pdf") for f in files]
+    if len(set(outs)) < len(outs):
+        raise ValueError("Files with the same name would overwrite each other's printouts")
+    if not files:
+        return
+    if processes is None:
+        processes = os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(
+            min(processes, len(files)), initializer=warm_up, initargs=(options,)) as pool:
+        # a single worker process per file, they already use every CPU
+        futures = {pool.submit(encode_printout, f, out, processes=1, **options): (f, out)
+                   for f, out in zip(files, outs)}
+        for future in concurrent.futures.as_completed(futures):
+            source, out = futures[future]
+            try:
+                pages = future.result()
+            except (OSError, ValueError) as e:
+                print("{}: {}".format(source, e))
+                pages = None
+            yield source, out, pages
@@ -0,0 +1,151 @@
+"""
+The papup command:
+
+    papup encode FILE [-o OUT.pdf] [--qr]    print a file to PDF
+    papup batch FILE|DIR... [-d OUTDIR]      print many files, one PDF each
+    papup decode IMAGE... -o FILE            read block grid pages back
+    papup scan SCAN... [-d OUTDIR]           read QR printouts back
+
+Heavy dependencies (reportlab, qrcode, PIL, NumPy, pyzbar) are imported by
+the commands that need them, so starting the command stays cheap.
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+
+# names of the payload compression methods, see payload.COMPRESSION_METHODS
+COMPRESSION_NAMES = {"store": 0, "bz2": 1, "zlib": 2, "xz": 3, "auto": "auto"}
+
+
+def printout_options(args):
+    return {"qr": args.qr, "redundancy": args.redundancy, "encoding": args.encoding,
+            "qr_mode": args.qr_mode, "description": args.description,
+            "compression": COMPRESSION_NAMES[args.compression], "compression_level": args.compression_level,
+            "compression_budget": args.compression_budget, "multi_stream": args.multi_stream}
+
+
+def encode(args):
+    from papup.batch import encode_printout
+    out = args.output or os.path.basename(args.file) + ".pdf"
+    pages = encode_printout(args.file, out, processes=args.processes, **printout_options(args))
+    print("{}: {} pages".format(out, pages))
+    return 0
+
+
+def batch(args):
+    from papup.batch import encode_batch
+    os.makedirs(args.directory, exist_ok=True)
+    failed = 0
+    for source, out, pages in encode_batch(args.sources, args.directory, args.processes,
+                                           **printout_options(args)):
+        if pages is None:
+            failed += 1
+        else:
+            print("{}: {} pages".format(out, pages))
+    return 1 if failed else 0
+
+
+def decode(args):
+    import PIL.Image
+    from papup.paper_reader import join_pages, read_page_image
+    from papup.payload import PapupPayload
+    pages = []
+    for name in args.images:
+        with PIL.Image.open(name) as img:
+            pages.append(read_page_image(img))
+        print("{}: {}".format(name, pages[-1]))
+    data, erasures = join_pages(pages)
+    with open(args.output, "wb") as out:
+        size = PapupPayload().unpack_to(out, data, erasures=erasures, processes=args.processes)
+    print("{}: {} bytes".format(args.output, size))
+    return 0
+
+
+def scan(args):
+    from papup.q2 import Scanner, ScanSession
+    session = ScanSession(args.session) if args.session else None
+    try:
+        scanner = Scanner(session)
+        if args.tiled:
+            scans = scanner.scan_tiled(args.sources, processes=args.processes)
+        else:
+            scans = scanner.scan_batch(args.sources, processes=args.processes)
+        if scanner.skipped:
+            print("{} pages already scanned in this session".format(scanner.skipped))
+        for page in scans:
+            print("{}: {} codes in {:.3f} s".format(page.name, len(page.codes), page.seconds))
+        os.makedirs(args.directory, exist_ok=True)
+        restored = scanner.restore(args.directory, args.overwrite)
+    finally:
+        if session is not None:
+            session.close()
+    for result in restored.values():
+        print("{}: {}".format(result.path, result.status))
+    return 1 if any(result.missing or not result.written for result in restored.values()) else 0
+
+
+def add_printout_arguments(p):
+    p.add_argument("--qr", action="store_true",
+                   help="print QR codes (read back with scan) instead of block grid pages")
+    p.add_argument("--redundancy", type=int, default=3, help="RS redundancy level of block grid pages")
+    p.add_argument("--compression", default="bz2", choices=list(COMPRESSION_NAMES),
+                   help="compression of block grid pages, auto picks the one needing the fewest pages")
+    p.add_argument("--compression-level", type=int, help="bz2/zlib level 1-9 or xz preset 0-9")
+    p.add_argument("--compression-budget", type=float,
+                   help="CPU seconds per MB auto may spend compressing")
+    p.add_argument("--multi-stream", action="store_true",
+                   help="compress blocks as independent streams, in parallel worker processes")
+    p.add_argument("--encoding", default="hex", choices=("hex", "base45"), help="QR part encoding")
+    p.add_argument("--qr-mode", default="image", choices=("image", "vector"))
+    p.add_argument("--description", help="description printed in the QR header")
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog="papup", description="Backup files on paper.")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="tell what is done, e.g. the compression used")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("encode", help="print a file to PDF")
+    p.add_argument("file")
+    p.add_argument("-o", "--output", help="PDF to write (default: FILE.pdf)")
+    add_printout_arguments(p)
+    p.add_argument("--processes", type=int, help="worker processes (threads for block grid pages)")
+    p.set_defaults(func=encode)
+
+    p = commands.add_parser("batch", help="print many files, one PDF each, in warm worker processes")
+    p.add_argument("sources", nargs="+", metavar="SOURCE", help="files or directories of them")
+    p.add_argument("-d", "--directory", default=".", help="directory to write FILE.pdf to")
+    add_printout_arguments(p)
+    p.add_argument("--processes", type=int, help="worker processes (default: one per CPU)")
+    p.set_defaults(func=batch)
+
+    p = commands.add_parser("decode", help="read a file from scanned block grid pages")
+    p.add_argument("images", nargs="+", metavar="IMAGE")
+    p.add_argument("-o", "--output", required=True, help="file to restore")
+    p.add_argument("--processes", type=int, help="worker processes for RS decoding")
+    p.set_defaults(func=decode)
+
+    p = commands.add_parser("scan", help="read files from scanned QR printouts")
+    p.add_argument("sources", nargs="+", metavar="SCAN", help="image files or directories of them")
+    p.add_argument("-d", "--directory", default=".", help="directory to restore the files to")
+    p.add_argument("--overwrite", action="store_true",
+                   help="replace existing files, e.g. to complete them from a resumed session")
+    p.add_argument("--session", help="sqlite database keeping the codes between runs")
+    p.add_argument("--tiled", action="store_true", help="decode the QR codes cell by cell")
+    p.add_argument("--processes", type=int, help="worker processes")
+    p.set_defaults(func=scan)
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(message)s")
+    try:
+        return args.func(args)
+    except (ImportError, OSError, ValueError) as e:
+        print("papup {}: {}".format(args.command, e), file=sys.stderr)
+        return 1
@@ -18,10 +18,7 @@ import math
 
 fname = "gpl-3.0.txt"
 
-with open(fname, "rb") as f:
-    data = f.read()
-
-LOGO = PIL.Image.open("logo.gif").convert("1")
+LOGO = None
 
 
 def iterate_chunks(l, n):
@@ -221,9 +218,18 @@ class PapupFile():
             print(page.generate_legend(self.uuid, len(self.pages)))
 
 
-pf = PapupFile(data)
-pf.generate_payload()
-pf.cut_pages()
-pf.generate_page_images()
-pf.pages[0].image.show()
-exit()
+def main():
+    global LOGO
+    with open(fname, "rb") as f:
+        data = f.read()
+    LOGO = PIL.Image.open("logo.gif").convert("1")
+
+    pf = PapupFile(data)
+    pf.generate_payload()
+    pf.cut_pages()
+    pf.generate_page_images()
+    pf.pages[0].image.show()
+
+
+if __name__ == "__main__":
+    main()
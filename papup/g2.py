@@ -4,16 +4,14 @@ Created on 2017-01-03
 @author: Peer Springstübe
 """
 
+import math
+import mmap
+import tempfile
 import uuid
 
-from paper import PapupPage
-from pdf import build_pdf
-from payload import PapupPayload
-
-fname = "faust1.txt"
-
-with open(fname, "rb") as f:
-    data = f.read()
+from papup.paper import PapupPage
+from papup.pdf import write_pdf
+from papup.payload import PapupPayload
 
 
 class PapupFile():
@@ -23,31 +21,57 @@ class PapupFile():
     BLOCK_WIDTH = 32
     PAGE_HEADER_SIZE = 64
 
+    COLUMNS = 15
+    FIRST_PAGE_ROWS = 16
+    PAGE_ROWS = 20
+
     def __init__(self, payload):
         self.uuid = uuid.uuid4()
         self.payload = payload
-        self.data_pos = 0
         self.pages = []
+        self.page_count = self.count_pages()
 
-    def data_left(self):
-        return self.data_pos < len(self.payload)
-
-    def cut_next_page(self, cols, rows):
+    @classmethod
+    def page_space(cls, cols, rows):
         # calculate space in page:
         blocks = cols * rows - 1
-        space = self.BLOCK_PAYLOAD * blocks - self.PAGE_HEADER_SIZE
-        # get data
-        page_data = self.payload[self.data_pos:self.data_pos + space]
-        self.pages.append(PapupPage(len(self.pages), page_data, cols, rows))
-        self.data_pos += space
+        return cls.BLOCK_PAYLOAD * blocks - cls.PAGE_HEADER_SIZE
+
+    @classmethod
+    def pages_for(cls, size):
+        """Pages needed for a payload of size bytes."""
+        first = cls.page_space(cls.COLUMNS, cls.FIRST_PAGE_ROWS)
+        rest = max(0, size - first)
+        return 1 + int(math.ceil(rest / cls.page_space(cls.COLUMNS, cls.PAGE_ROWS)))
+
+    def count_pages(self):
+        return self.pages_for(len(self.payload))
+
+    def iter_pages(self):
+        """
+        Cut the payload into pages lazily, page data are memoryview slices
+        of the payload, nothing is copied.
+        """
+        view = memoryview(self.payload)
+        pos = 0
+        for number in range(self.page_count):
+            rows = self.FIRST_PAGE_ROWS if number == 0 else self.PAGE_ROWS
+            space = self.page_space(self.COLUMNS, rows)
+            page = PapupPage(number, view[pos:pos + space], self.COLUMNS, rows)
+            page.file_id = self.uuid
+            page.total_pages = self.page_count
+            pos += space
+            yield page
+
+    def iter_page_images(self):
+        """Yield pages with legend and image, each rendered on demand."""
+        for page in self.iter_pages():
+            page.generate_page_legend()
+            page.generate_page_image()
+            yield page
 
     def cut_pages(self):
-        self.cut_next_page(15, 16)
-        while self.data_left():
-            self.cut_next_page(15, 20)
-        for page in self.pages:
-            page.file_id = self.uuid
-            page.total_pages = len(self.pages)
+        self.pages = list(self.iter_pages())
 
     def generate_page_images(self):
         for page in self.pages:
@@ -55,14 +79,26 @@ class PapupFile():
             page.generate_page_image()
 
 
-pl = PapupPayload()
-pl.set_content(data)
-pl.pack_payload()
-
-pf = PapupFile(pl.data)
-pf.cut_pages()
-pf.generate_page_images()
-print(pf.pages[0].page_legend)
-# pf.pages[0].image.show()
-
-build_pdf(pf, 'out.pdf')
+def encode_file(source_name, pdf_name, payload=None, threads=None, processes=None):
+    """
+    Pack file source_name with payload (a PapupPayload, default settings if
+    None) and print it into PDF pdf_name, threads compress the page images,
+    processes the streams of a multi_stream payload. Returns the number of
+    pages.
+    """
+    pl = payload or PapupPayload()
+    if pl.count_pages is None:
+        # lets compression="auto" count in pages
+        pl.count_pages = PapupFile.pages_for
+    # payload goes to a temporary file, pages are cut from a mapping of it
+    with open(source_name, "rb") as source, tempfile.TemporaryFile() as packed:
+        pl.pack_to(packed, source, processes)
+        packed.flush()
+        with mmap.mmap(packed.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            pf = PapupFile(mapped)
+            write_pdf(pf.iter_page_images(), pdf_name, threads)
+            return pf.page_count
+
+
+if __name__ == "__main__":
+    print("{} pages".format(encode_file("faust1.txt", "out.pdf")))
@@ -0,0 +1,26 @@
+"""
+Page geometry in points, shared by printing and scanning. Values are those
+of reportlab, which is not imported here, so the block grid PDF writer and
+the scanner can use them without loading it.
+"""
+
+# reportlab.lib.units
+cm = 72.0 / 2.54
+mm = cm * 0.1
+# reportlab.lib.pagesizes
+A4 = (210 * mm, 297 * mm)
+
+# QR codes per row and the space between them
+QR_PER_ROW = 6
+QR_SPACE = 0.3 * cm
+
+
+def qr_grid(page_size=A4, border_left=1 * cm, border_right=1 * cm):
+    """
+    Horizontal QR grid of a page as (x0, pitch, width) in points: left edge
+    of the first column, distance between columns and QR code width. Used by
+    PapupLayout and to find the codes on scanned pages.
+    """
+    vp_width = page_size[0] - border_left - border_right
+    qw = (vp_width - (QR_PER_ROW - 1) * QR_SPACE) / QR_PER_ROW
+    return border_left, QR_SPACE + qw, qw
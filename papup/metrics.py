@@ -0,0 +1,208 @@
+"""
+Timers and counters for the stages of encoding and decoding.
+
+Stages report their time and counters (bytes_in, bytes_out, codewords,
+blocks, qr_symbols, pages, ...) here. Nothing is measured unless a callback
+is registered or a collect() block is running, so the hooks cost nothing
+otherwise.
+
+    with metrics.collect() as m:
+        payload.pack_payload()
+    print(json.dumps(m.as_dict()))
+
+Callbacks are called as callback(stage, seconds, counters) for every stage
+run, seconds is None for counters reported without a timer.
+"""
+
+import contextlib
+import time
+
+# number of functions listed in Metrics.as_dict() when profiling
+PROFILE_TOP = 25
+
+_callbacks = []
+_collectors = []
+
+
+def register(callback):
+    """Call callback for every stage from now on, returns callback."""
+    _callbacks.append(callback)
+    return callback
+
+
+def unregister(callback):
+    _callbacks.remove(callback)
+
+
+def enabled():
+    return bool(_callbacks or _collectors)
+
+
+def record(stage, seconds=None, **counters):
+    """Report a stage run of seconds (None: counters only) to all listeners."""
+    for collector in _collectors:
+        collector.add(stage, seconds, counters)
+    for callback in _callbacks:
+        callback(stage, seconds, counters)
+
+
+@contextlib.contextmanager
+def timer(stage, **counters):
+    """
+    Time the block as stage. Yields the counters dict, the block can add
+    to it until it ends.
+    """
+    if not enabled():
+        yield counters
+        return
+    t0 = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        record(stage, time.perf_counter() - t0, **counters)
+
+
+def iter_stage(stage, f, chunks):
+    """
+    Run the generator stage f over chunks, timing only the time spent in f
+    itself, not in the stages feeding chunks. Counts bytes_in and bytes_out.
+    """
+    if not enabled():
+        return f(chunks)
+    return _iter_stage(stage, f, chunks)
+
+
+def _iter_stage(stage, f, chunks):
+    counters = {"bytes_in": 0, "bytes_out": 0}
+    upstream = [0.0]
+
+    def feed():
+        it = iter(chunks)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                chunk = next(it)
+            except StopIteration:
+                return
+            finally:
+                upstream[0] += time.perf_counter() - t0
+            counters["bytes_in"] += len(chunk)
+            yield chunk
+
+    total = 0.0
+    out = f(feed())
+    try:
+        while True:
+            t0 = time.perf_counter()
+            try:
+                chunk = next(out)
+            except StopIteration:
+                break
+            finally:
+                total += time.perf_counter() - t0
+            counters["bytes_out"] += len(chunk)
+            yield chunk
+    finally:
+        record(stage, total - upstream[0], **counters)
+
+
+def iter_timed(stage, items, counter):
+    """
+    Iterate over items, timing the waits for the next item as stage and
+    counting the items in counter.
+    """
+    if not enabled():
+        return iter(items)
+    return _iter_timed(stage, items, counter)
+
+
+def _iter_timed(stage, items, counter):
+    total = 0.0
+    count = 0
+    it = iter(items)
+    try:
+        while True:
+            t0 = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                break
+            finally:
+                total += time.perf_counter() - t0
+            count += 1
+            yield item
+    finally:
+        record(stage, total, **{counter: count})
+
+
+class Metrics():
+    """Stage totals collected by collect(), e.g. for a single job."""
+
+    def __init__(self):
+        # stage -> {"calls": ..., "seconds": ..., counters...}
+        self.stages = {}
+        self.seconds = None
+        self.profile = None
+        self.memory_peak = None
+
+    def add(self, stage, seconds, counters):
+        totals = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0})
+        if seconds is not None:
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+        for name, value in counters.items():
+            totals[name] = totals.get(name, 0) + value
+
+    def profile_top(self, n=PROFILE_TOP):
+        """The n functions with the highest cumulative time of the profile."""
+        if self.profile is None:
+            return None
+        import pstats
+        stats = pstats.Stats(self.profile)
+        rows = []
+        for (file_name, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+            rows.append({"function": "{}:{}({})".format(file_name, line, name),
+                         "calls": calls, "tottime": tottime, "cumtime": cumtime})
+        rows.sort(key=lambda r: r["cumtime"], reverse=True)
+        return rows[:n]
+
+    def as_dict(self):
+        """JSON compatible breakdown of the collected stages."""
+        d = {"seconds": self.seconds, "stages": self.stages}
+        if self.profile is not None:
+            d["profile"] = self.profile_top()
+        if self.memory_peak is not None:
+            d["memory_peak"] = self.memory_peak
+        return d
+
+
+@contextlib.contextmanager
+def collect(profile=False, trace_memory=False):
+    """
+    Collect the stages run in the block into the yielded Metrics. With
+    profile, the block runs under cProfile, with trace_memory, the peak of
+    memory allocated by python (tracemalloc) is recorded. Both slow the
+    block down considerably.
+    """
+    # only needed in capture mode, keep them out of the command's start up
+    import cProfile
+    import tracemalloc
+    m = Metrics()
+    _collectors.append(m)
+    if trace_memory:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+    if profile:
+        m.profile = cProfile.Profile()
+        m.profile.enable()
+    t0 = time.perf_counter()
+    try:
+        yield m
+    finally:
+        m.seconds = time.perf_counter() - t0
+        if profile:
+            m.profile.disable()
+        if trace_memory:
+            m.memory_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        _collectors.remove(m)
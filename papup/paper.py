@@ -4,23 +4,28 @@ Created on 2017-01-03
 @author: Peer Springstübe
 """
 
+import os.path
 import struct
 import binascii
 import math
 import PIL.Image
-import PIL.ImageDraw
 
-import unireedsolomon
-from __init__ import PAPUP_IDENT, PAPUP_VERSION
+from papup import PAPUP_IDENT, PAPUP_VERSION, metrics
+from papup.reedsolomon import get_codec
 
 
 LOGO = None
+LOGO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logo.gif")
+
+# PIL's raw "1" mode uses set bits for white pixels, papup blocks use set
+# bits for black ones
+INVERT_TABLE = bytes(0xFF - b for b in range(256))
 
 
 def get_logo():
     global LOGO
     if LOGO is None:
-        LOGO = PIL.Image.open("logo.gif").convert("1")
+        LOGO = PIL.Image.open(LOGO_PATH).convert("1")
     return LOGO
 
 
@@ -30,6 +35,42 @@ def iterate_chunks(l, n):
         yield l[i:i + n]
 
 
+def split_blocks(raw):
+    """
+    Split block bytes as read back from a page (BLOCK_PAYLOAD bytes followed
+    by their CRC32 for every block) into the page data without the CRCs and
+    the indices of the blocks whose CRC32 does not match.
+    """
+    payload = PapupPage.BLOCK_PAYLOAD
+    size = payload + 4
+    data = bytearray()
+    bad_blocks = []
+    for n, i in enumerate(range(0, len(raw), size)):
+        block = raw[i:i + payload]
+        crc, = struct.unpack("!L", raw[i + payload:i + size])
+        if crc != binascii.crc32(block):
+            bad_blocks.append(n)
+        data += block
+    return bytes(data), bad_blocks
+
+
+def erasures_from_blocks(bad_blocks):
+    """
+    Offsets in the page data (page header included) of all bytes in the given
+    blocks, to be used as erasures in the RS layer.
+    """
+    payload = PapupPage.BLOCK_PAYLOAD
+    erasures = []
+    for n in bad_blocks:
+        erasures.extend(range(n * payload, (n + 1) * payload))
+    return erasures
+
+
+def shift_erasures(erasures, start, stop=None):
+    """Erasures in [start, stop), made relative to start."""
+    return [e - start for e in erasures if e >= start and (stop is None or e < stop)]
+
+
 class PapupPage():
     BLOCK_PAYLOAD = 124
     BLOCK_WIDTH = 32
@@ -69,8 +110,7 @@ class PapupPage():
         header_raw = PAPUP_IDENT + struct.pack("!B", PAPUP_VERSION) + self.file_id.bytes + struct.pack(
             "!LLHH", self.page_number, self.total_pages, self.actual_blocks, self.cols)
         assert(len(header_raw) == 34)
-        rs = unireedsolomon.RSCoder(64, 34)
-        header_rs = rs.encode(header_raw).encode("L1")
+        header_rs = get_codec(64, 34).encode(header_raw)
         assert(len(header_rs) == 64)
         return header_rs
 
@@ -79,46 +119,78 @@ class PapupPage():
         assert(self.file_id is not None)
         assert(self.total_pages is not None)
         #
-        page_header = self.generate_page_header()
-
-        total_data = page_header + self.data
-
-        block_images = self.generate_block_images(total_data)
-
-        # generate total image and put blocks there
-        iw = self.cols * (self.BLOCK_WIDTH + 3) + 1 + 2 * 4
-        ih = self.actual_rows * (self.BLOCK_WIDTH + 3) + 1 + 2 * 4
-
-        im = PIL.Image.new("1", (iw, ih), "white")
-        for n, block in enumerate(block_images):
-            bx = (n + 1) % self.cols
-            by = (n + 1) // self.cols
-            x = bx * (self.BLOCK_WIDTH + 3) + 4
-            y = by * (self.BLOCK_WIDTH + 3) + 4
-            im.paste(block, (x + 2, y + 2))
-        draw = PIL.ImageDraw.Draw(im)
-        # draw vertical grid lines
+        with metrics.timer("paper.page_image", pages=1, blocks=self.actual_blocks, bytes_in=len(self.data)):
+            page_header = self.generate_page_header()
+
+            total_data = page_header + self.data
+
+            # generate total image with all blocks and the grid in one pass
+            iw = self.cols * (self.BLOCK_WIDTH + 3) + 1 + 2 * 4
+            ih = self.actual_rows * (self.BLOCK_WIDTH + 3) + 1 + 2 * 4
+            bitmap = self.rasterize_blocks(total_data, iw, ih)
+
+            im = PIL.Image.frombytes("1", (iw, ih), bitmap)
+            im.paste(get_logo(), (5, 5))
+            self.page_image = im
+
+    def rasterize_blocks(self, data, iw, ih):
+        """
+        Render blocks and grid into a packed 1-bit bitmap (rows padded to full
+        bytes, set bits are white) of size iw x ih, as used by PIL's "1" mode.
+
+        Every pixel row is assembled as a single python integer, so there is
+        no per pixel work at all.
+        """
+        pitch = self.BLOCK_WIDTH + 3
+        stride = (iw + 7) // 8
+        bits = stride * 8
+        word_rows = "!{}L".format(self.BLOCK_WIDTH)
+        # vertical grid lines run through every pixel row:
+        vlines = 0
         for x in range(self.cols + 1):
-            xx = x * (self.BLOCK_WIDTH + 3) + 4
-            draw.line((xx, 0, xx, im.size[1]), "black")
-        # draw horizontal grid lines
-        for y in range(self.actual_rows + 1):
-            yy = y * (self.BLOCK_WIDTH + 3) + 4
-            draw.line((0, yy, im.size[0], yy), "black")
-        im.paste(get_logo(), (5, 5))
-        self.page_image = im
+            vlines |= 1 << (bits - 1 - (x * pitch + 4))
+        hline = (1 << bits) - 1
+        # shift for each column, so that a 32 bit block row lands on its pixels:
+        shifts = [bits - (bx * pitch + 6 + self.BLOCK_WIDTH)
+                  for bx in range(self.cols)]
+        # all blocks as lists of 32 bit rows, first cell holds the logo:
+        blocks = [None]
+        for chunk in self.iterate_blocks(data):
+            blocks.append(struct.unpack(word_rows, chunk))
+        blocks += [None] * (self.actual_rows * self.cols - len(blocks))
+
+        vline_row = vlines.to_bytes(stride, "big")
+        hline_row = hline.to_bytes(stride, "big")
+        rows = [vline_row] * 4
+        for by in range(self.actual_rows):
+            rows.append(hline_row)
+            rows.append(vline_row)
+            row_blocks = [(words, shift) for words, shift
+                          in zip(blocks[by * self.cols:(by + 1) * self.cols], shifts)
+                          if words is not None]
+            for y in range(self.BLOCK_WIDTH):
+                row = vlines
+                for words, shift in row_blocks:
+                    row |= words[y] << shift
+                rows.append(row.to_bytes(stride, "big"))
+            rows.append(vline_row)
+        rows.append(hline_row)
+        rows += [vline_row] * 4
+        assert(len(rows) == ih)
+        return b"".join(rows).translate(INVERT_TABLE)
+
+    def iterate_blocks(self, data):
+        """Yield the padded blocks of data, each with its CRC32 appended."""
+        for chunk in iterate_chunks(data, self.BLOCK_PAYLOAD):
+            if len(chunk) < self.BLOCK_PAYLOAD:
+                chunk += self.FILL_BYTE * (self.BLOCK_PAYLOAD - len(chunk))
+            yield chunk + struct.pack("!L", binascii.crc32(chunk))
 
     def generate_block_image(self, data):
         assert(len(data) == self.BLOCK_PAYLOAD)
         data = data + struct.pack("!L", binascii.crc32(data))
-        im = PIL.Image.new("1", (self.BLOCK_WIDTH, self.BLOCK_WIDTH), "white")
-        for y in range(self.BLOCK_WIDTH):
-            for x in range(self.BLOCK_WIDTH // 8):
-                b = data[y * (self.BLOCK_WIDTH // 8) + x]
-                for bn in range(8):
-                    if (0x80 >> bn) & b:
-                        im.putpixel((x * 8 + bn, y), 0x0)
-        return im
+        return PIL.Image.frombytes("1", (self.BLOCK_WIDTH, self.BLOCK_WIDTH),
+                                   data.translate(INVERT_TABLE))
 
     def generate_block_images(self, data):
         block_images = []
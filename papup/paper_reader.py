@@ -0,0 +1,214 @@
+"""
+Reader for scanned pages of the paper.PapupPage block grid.
+
+The grid lines are found in the binarized page, every bit of every cell is
+sampled in one pass with NumPy and packed back into blocks. Blocks failing their CRC32 become erasures for the RS
+layers (page header and payload).
+"""
+
+import struct
+import uuid
+
+import numpy as np
+
+from papup import PAPUP_IDENT, PAPUP_VERSION
+from papup.paper import PapupPage, split_blocks, erasures_from_blocks, shift_erasures
+from papup.reedsolomon import ReedSolomonError, get_codec
+
+# distance of two grid lines in bits
+GRID_PITCH = PapupPage.BLOCK_WIDTH + 3
+# pixel rows that are dark for at least this share of the longest dark run
+# are lines; data rows are broken up by the gaps between the blocks
+LINE_FRACTION = 0.5
+# neighbouring lines further off the median distance end the grid
+PITCH_TOLERANCE = 0.1
+# grid lines are searched on a copy reduced to about this many pixels per bit
+SEARCH_PIXELS_PER_BIT = 2.5
+# A4 width in points, one bit of the page image is printed as one point
+PAGE_WIDTH = 595
+
+
+def otsu_threshold(arr):
+    """Grey level separating dark from light pixels of a uint8 array."""
+    hist = np.bincount(arr.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    s0 = np.cumsum(hist * levels)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        var = w0 * w1 * (s0 / w0 - (s0[-1] - s0) / w1) ** 2
+    return int(np.nanargmax(var))
+
+
+def longest_runs(dark):
+    """Length of the longest run of dark pixels in every row."""
+    count = np.cumsum(dark, axis=1, dtype=np.int32)
+    last_light = np.maximum.accumulate(np.where(dark, 0, count), axis=1)
+    return (count - last_light).max(axis=1)
+
+
+def line_centers(profile, fraction):
+    """Centers of the runs of profile values of at least fraction of its maximum."""
+    lines = np.flatnonzero(profile >= fraction * profile.max())
+    if len(lines) == 0:
+        return np.array([])
+    breaks = np.flatnonzero(np.diff(lines) > 1)
+    starts = np.concatenate(([lines[0]], lines[breaks + 1]))
+    ends = np.concatenate((lines[breaks], [lines[-1]]))
+    return (starts + ends) / 2
+
+
+def refine_centers(dark, centers, radius):
+    """Centers of the dark rows within radius of every estimated center."""
+    refined = []
+    for c in centers:
+        lo = max(0, int(c - radius))
+        sums = dark[lo:int(c + radius) + 1].sum(axis=1)
+        refined.append(lo + np.flatnonzero(sums >= sums.max() / 2).mean())
+    return np.array(refined)
+
+
+def grid_lines(centers):
+    """
+    Longest sequence of line centers with about the same distance between
+    neighbours, leaving out other lines on the page (e.g. below the legend).
+    """
+    if len(centers) < 2:
+        raise ValueError("No grid found")
+    diffs = np.diff(centers)
+    pitch = np.median(diffs)
+    best = (0, 0)
+    start = 0
+    for i, d in enumerate(diffs):
+        if abs(d - pitch) > PITCH_TOLERANCE * pitch:
+            start = i + 1
+        elif i + 1 - start > best[1] - best[0]:
+            best = (start, i + 1)
+    if best == (0, 0):
+        raise ValueError("No grid found")
+    return centers[best[0]:best[1] + 1]
+
+
+def sample_offsets(lines):
+    """Pixel coordinates of the 32 bit centers of every cell behind lines."""
+    unit = np.diff(lines) / GRID_PITCH
+    # a line is a single bit, followed by one white bit before the block
+    bits = np.arange(PapupPage.BLOCK_WIDTH) + 2
+    return np.rint(lines[:-1, None] + bits[None, :] * unit[:, None]).astype(np.intp), unit.min()
+
+
+class ScannedPage():
+    """Header fields and data of a page read back from an image."""
+
+    def __init__(self, file_id, page_number, total_pages, actual_blocks, cols, data, bad_blocks):
+        self.file_id = file_id
+        self.page_number = page_number
+        self.total_pages = total_pages
+        self.actual_blocks = actual_blocks
+        self.cols = cols
+        # page data (page header removed), padded to full blocks
+        self.data = data
+        self.bad_blocks = bad_blocks
+        # offsets in data of bytes from blocks with a bad CRC32
+        self.erasures = shift_erasures(erasures_from_blocks(bad_blocks), PapupPage.PAGE_HEADER_SIZE)
+
+    def __repr__(self):
+        return "<ScannedPage {} {}/{} blocks={} bad={}>".format(
+            self.file_id, self.page_number + 1, self.total_pages, self.actual_blocks, len(self.bad_blocks))
+
+
+def find_grid(arr, threshold):
+    """
+    Centers of the horizontal and vertical grid lines in a greyscale page.
+    Horizontal lines are the long dark runs in a reduced copy of the page.
+    The pixel rows right next to them are white except for the vertical
+    lines, so those are looked for there only.
+    """
+    dark = arr <= threshold
+    factor = max(1, int(arr.shape[1] / PAGE_WIDTH / SEARCH_PIXELS_PER_BIT))
+    small = dark[:arr.shape[0] // factor * factor].reshape(arr.shape[0] // factor, factor, -1)
+    small = small.any(axis=1)[:, ::factor]
+    hlines = grid_lines(line_centers(longest_runs(small), LINE_FRACTION)) * factor + (factor - 1) / 2
+    unit = np.median(np.diff(hlines)) / GRID_PITCH
+    hlines = refine_centers(dark, hlines, unit)
+    gaps = np.rint(np.concatenate((hlines - unit, hlines + unit))).astype(np.intp)
+    gaps = gaps[(gaps >= 0) & (gaps < arr.shape[0])]
+    vlines = grid_lines(line_centers(dark[gaps].mean(axis=0), 0.75))
+    vlines = refine_centers(dark.T, vlines, unit)
+    return hlines, vlines
+
+
+def read_cells(img):
+    """
+    All grid cells of a page image as an array of block bytes (BLOCK_PAYLOAD
+    bytes and CRC32 each), row by row, the logo cell included, and the
+    number of columns.
+    """
+    arr = np.asarray(img.convert("L"))
+    threshold = otsu_threshold(arr)
+    hlines, vlines = find_grid(arr, threshold)
+    ys, unit = sample_offsets(hlines)
+    xs, xunit = sample_offsets(vlines)
+    # average a small square around every bit center on high resolution scans
+    radius = int(min(unit, xunit) / 4)
+    total = np.zeros((ys.shape[0], ys.shape[1], xs.shape[0], xs.shape[1]), dtype=np.uint32)
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            total += arr[(ys + dy)[:, :, None, None], (xs + dx)[None, None, :, :]]
+    samples = (total // (2 * radius + 1) ** 2).astype(np.uint8)
+    # the grid alone has a much clearer split into dark and light than the page
+    bits = samples <= otsu_threshold(samples)
+    # (row, bit row, column, bit) -> (cell, bits of the cell)
+    bits = bits.transpose(0, 2, 1, 3).reshape(ys.shape[0] * xs.shape[0], -1)
+    return np.packbits(bits, axis=1), xs.shape[0]
+
+
+def read_page_header(block):
+    """Decode the RS(64, 34) page header at the start of the first block."""
+    data, bad = split_blocks(block)
+    erasures = list(range(PapupPage.PAGE_HEADER_SIZE)) if bad else None
+    raw, report = get_codec(64, 34).decode(data[:PapupPage.PAGE_HEADER_SIZE], erasures=erasures)
+    if report.failed:
+        raise ReedSolomonError("Page header cannot be repaired")
+    if raw[:len(PAPUP_IDENT)] != PAPUP_IDENT:
+        raise ValueError("No papup page")
+    version = raw[len(PAPUP_IDENT)]
+    if version != PAPUP_VERSION:
+        raise ValueError("Unsupported papup version: {}".format(version))
+    file_id = uuid.UUID(bytes=bytes(raw[6:22]))
+    return (file_id,) + struct.unpack("!LLHH", raw[22:34])
+
+
+def read_page_image(img):
+    """Read a page from a PIL image of a printed (and scanned) page."""
+    cells, cols = read_cells(img)
+    file_id, page_number, total_pages, actual_blocks, header_cols = read_page_header(cells[1].tobytes())
+    if header_cols != cols:
+        raise ValueError("Grid has {} columns, page header says {}".format(cols, header_cols))
+    if len(cells) < actual_blocks + 1:
+        raise ValueError("Grid has {} blocks, page header says {}".format(len(cells) - 1, actual_blocks))
+    data, bad_blocks = split_blocks(cells[1:actual_blocks + 1].tobytes())
+    return ScannedPage(file_id, page_number, total_pages, actual_blocks, cols,
+                       data[PapupPage.PAGE_HEADER_SIZE:], bad_blocks)
+
+
+def join_pages(pages):
+    """
+    Payload and erasures (offsets of bytes known to be bad) from all pages
+    of a file, in any order, to be handed to PapupPayload.unpack_to.
+    """
+    pages = sorted(pages, key=lambda p: p.page_number)
+    if not pages:
+        raise ValueError("No pages")
+    numbers = [p.page_number for p in pages]
+    if numbers != list(range(pages[0].total_pages)):
+        missing = sorted(set(range(pages[0].total_pages)) - set(numbers))
+        raise ValueError("Missing pages: {}".format([n + 1 for n in missing]))
+    if len({p.file_id for p in pages}) > 1:
+        raise ValueError("Pages of different files")
+    erasures = []
+    pos = 0
+    for page in pages:
+        erasures.extend(pos + e for e in page.erasures)
+        pos += len(page.data)
+    return b"".join(p.data for p in pages), erasures
@@ -1,29 +1,161 @@
+import collections
+import concurrent.futures
+import functools
+import io
+import itertools
 import json
 import math
+import os
+import re
 import textwrap
 
-import qrcode
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import mm, cm
+import PIL.Image
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfgen import canvas
 
+from papup import metrics
+from papup.geometry import A4, QR_PER_ROW, QR_SPACE, cm, qr_grid
 
+
+@functools.lru_cache(maxsize=None)
 def get_font_height(name, size):
     face = pdfmetrics.getFont(name).face
     return (face.ascent - face.descent) / 1000 * size
 
 
+# QR codes computed per job in the process pool
+QR_BATCH_SIZE = 16
+# pixels per module of the QR images, as qrcode's default box size
+QR_BOX_SIZE = 10
+QR_MODULE_GREY = bytes.maketrans(b"\x00\x01", b"\xff\x00")
+QR_DARK_RUN = re.compile(b"\x01+")
+LOGO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logo.gif")
+LOGO = None
+
+
+def get_logo():
+    """The header logo, read from disk once per process."""
+    global LOGO
+    if LOGO is None:
+        with PIL.Image.open(LOGO_PATH) as im:
+            im.load()
+            LOGO = im
+    return LOGO
+
+
+def make_qr_matrix(data):
+    """
+    QR code for data, with version fitting and mask selection, as (size,
+    modules), modules holding one byte per module row by row, 1 for dark.
+    """
+    # imported here, so that scanning does not have to load it
+    import qrcode
+    qr = qrcode.QRCode(border=0)
+    qr.add_data(data)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    return len(matrix), bytes(itertools.chain.from_iterable(matrix))
+
+
+def make_qr_matrices(datas):
+    return [make_qr_matrix(data) for data in datas]
+
+
+def qr_matrix_image(matrix):
+    """PIL image of a QR matrix, the same as qrcode's make_image."""
+    size, modules = matrix
+    img = PIL.Image.frombytes("L", (size, size), modules.translate(QR_MODULE_GREY))
+    return img.resize((size * QR_BOX_SIZE, size * QR_BOX_SIZE), PIL.Image.NEAREST).convert("1")
+
+
+def draw_qr_vector(canv, matrix, x, y, width):
+    """
+    Draw a QR matrix as filled rectangles with its lower left corner at x, y.
+    Every row is a path of one rectangle per run of dark modules, filled,
+    then the coordinate system moves down a row, so all rectangles are
+    "x 0 w 1 re" in module units: short and repetitive, which compresses
+    well in the page stream.
+    """
+    size, modules = matrix
+    ops = ["1 0 0 1 0 {} cm".format(size - 1)]
+    for row in range(size):
+        line = modules[row * size:(row + 1) * size]
+        runs = ["{} 0 {} 1 re".format(r.start(), r.end() - r.start()) for r in QR_DARK_RUN.finditer(line)]
+        if runs:
+            ops.append(" ".join(runs) + " f")
+        ops.append("1 0 0 1 0 -1 cm")
+    canv.saveState()
+    canv.translate(x, y)
+    canv.scale(width / size, width / size)
+    canv.setFillGray(0.0)
+    canv.addLiteral("\n".join(ops))
+    canv.restoreState()
+
+
+def iter_qr_matrices(items, processes=None, batch_size=QR_BATCH_SIZE):
+    """
+    For (data, title) items yield (data, title, matrix) in order. Matrices are
+    computed in a process pool ahead of the consumer, with at most two batches
+    per process waiting, so memory stays flat however many codes there are.
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    items = iter(items)
+    if processes <= 1:
+        for data, title in items:
+            yield data, title, make_qr_matrix(data)
+        return
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        pending = collections.deque()
+        while True:
+            batch = list(itertools.islice(items, batch_size))
+            if batch:
+                pending.append((batch, pool.submit(make_qr_matrices, [data for data, title in batch])))
+            if pending and (not batch or len(pending) >= 2 * processes):
+                batch, future = pending.popleft()
+                for (data, title), matrix in zip(batch, future.result()):
+                    yield data, title, matrix
+            elif not batch:
+                return
+
+
+# document worker processes render pages of, see PapupDocument.render_parallel
+_worker_pu = None
+_worker_qr_mode = None
+
+
+def _init_page_worker(pu, qr_mode):
+    global _worker_pu, _worker_qr_mode
+    _worker_pu = pu
+    _worker_qr_mode = qr_mode
+
+
+def render_pages_pdf(pages):
+    """Render the given pages of the worker's document into PDF bytes."""
+    buf = io.BytesIO()
+    doc = PapupDocument(_worker_pu, file_name=buf, qr_mode=_worker_qr_mode)
+    doc.render(pages, processes=1)
+    return buf.getvalue()
+
+
 class PapupDocument:
-    def __init__(self, pu):
+    # how QR codes are put into the PDF: "image" embeds an inline image per
+    # code, "vector" draws the modules as filled rectangles
+    QR_MODES = ("image", "vector")
+
+    def __init__(self, pu, file_name="out.pdf", qr_mode="image"):
+        if qr_mode not in PapupDocument.QR_MODES:
+            raise ValueError("Invalid QR mode: {}".format(qr_mode))
         self.page_size = A4
         self.border_top = 1 * cm
         self.border_bottom = 1 * cm
         self.border_left = 1 * cm
         self.border_right = 1 * cm
-        self.file_name = "out.pdf"
-        self.canvas = canvas.Canvas(self.file_name, pagesize=self.page_size)
+        self.file_name = file_name
+        self.qr_mode = qr_mode
+        self.canvas = canvas.Canvas(self.file_name, pagesize=self.page_size, pageCompression=1)
         self.pu = pu
+        self.layout = None
 
     def header_height(self):
         font_name = "Courier"
@@ -65,7 +197,7 @@ class PapupDocument:
         self.canvas.setFont(font_name, font_size)
         w0 = self.border_left
         h0 = self.page_size[1] - self.border_top
-        self.canvas.drawInlineImage("logo.gif", w0, h0 - 2 * cm, 2 * cm, 2 * cm)
+        self.canvas.drawInlineImage(get_logo(), w0, h0 - 2 * cm, 2 * cm, 2 * cm)
         self.canvas.drawString(w0 + 2 * cm + 0.2 * cm, h0 - font_height, "PAPUP FILE PRINTOUT v0.1")
         hd = font_height * 1.5
         # id and page number
@@ -96,6 +228,8 @@ class PapupDocument:
             hd += font_height * 1.5
         hd += font_height * 0.5
         # instruction:
+        tag = self.pu.part_tag
+        encoding = self.pu.encoding
         font_name = "Courier"
         font_size = 9
         font_height = get_font_height(font_name, font_size)
@@ -104,16 +238,16 @@ class PapupDocument:
                         "PAPUP is a standard for printing files on paper - see https://github.com/kratenko/papup")
         hd += font_height * 1.5
         self.canvas.drawString(w0, h0 - hd - font_height,
-                        "This printout holds a single file. Each QR-Code starting with 'PUD:' hold hex-encoded data.")
+                        f"This printout holds a single file. Each QR-Code starting with '{tag}:' hold {encoding}-encoded data.")
         hd += font_height * 1.5
         self.canvas.drawString(w0, h0 - hd - font_height,
-                        "Format: 'PUD:<file-id>:<part_number>/<total_parts>:<hexdata>', part number starts at 1.")
+                        f"Format: '{tag}:<file-id>:<part_number>/<total_parts>:<{encoding}data>', part number starts at 1.")
         hd += font_height * 1.5
         self.canvas.drawString(w0, h0 - hd - font_height,
                         "QR-Codes starting with 'PUM:' hold metadata, QR-Codes starting with 'PUR': hold redundancy (parity).")
         hd += font_height * 1.5
         self.canvas.drawString(w0, h0 - hd - font_height,
-                        "Concatenate the data from QR-Codes with 'PUD:' to restore the file. Verify using sha256 checksum.")
+                        f"Concatenate the data from QR-Codes with '{tag}:' to restore the file. Verify using sha256 checksum.")
         hd += font_height * 1.5
         # footer:
         self.canvas.drawString(w0, cm, f"Page {1}/{pages} - ID:{self.pu.ident}")
@@ -155,84 +289,174 @@ class PapupDocument:
         self.canvas.setFillGray(.5)
 
 
+    def get_layout(self):
+        """The layout plan of this document, computed on first use."""
+        if self.layout is None:
+            self.layout = PapupLayout(self)
+        return self.layout
+
     def total_qr(self):
-        header_json = json.dumps(self.pu.get_header())
-        h_cnt = int(math.ceil(len(header_json) / self.pu.part_size))
-        return h_cnt + self.pu.part_count
+        return self.get_layout().total
 
     def all_qr(self):
-        header_json = json.dumps(self.pu.get_header())
-        h_cnt = int(math.ceil(len(header_json) / self.pu.part_size))
-        for n in range(h_cnt):
-            title = f"PUM:{self.pu.ident}:{n+1}/{h_cnt}"
-            data = title + ":" + header_json[n*self.pu.part_size:(n+1)*self.pu.part_size]
-            yield data, title
-        for y in self.pu.qr_parts_with_title():
-            yield y
-
-    def render(self):
-        # how many qrs do we have:
-        total = self.total_qr()
-        # calculate view port for page 1:
-        header_height = self.header_height()
-        footer_height = self.footer_height()
-        vp_width = self.page_size[0] - self.border_left - self.border_right
-        vp_height = self.page_size[1] - header_height - footer_height - self.border_top - self.border_bottom
-        space = 0.3 * cm
-        per_row = 6
-        # calculate qr code size:
-        qw = (vp_width - (per_row - 1) * space) / per_row
-        qh = qw + 0.7 * cm
-        per_col = int((vp_height+0.7*cm) // qh)
-        qrs_page1 = per_row * per_col
-        # calculate view port for page 2:
-        header2_height = self.header2_height()
-        vp_height2 = self.page_size[1] - header2_height - footer_height - self.border_top - self.border_bottom
-        per_col2 = int((vp_height2+0.7*cm) // qh)
-        qrs_page2 = per_row * per_col2
-        print(total, qrs_page1, qrs_page2)
-        if total <= qrs_page1:
-            pages = 1
-        else:
-            pages = 1 + int(math.ceil((total - qrs_page1) / qrs_page2))
-        self.draw_header(1, pages)
+        layout = self.get_layout()
+        for n in range(layout.total):
+            yield layout.qr_item(n)
+
+    def render(self, pages=None, processes=None):
+        """
+        Render the document, or only the given page numbers (starting at 1),
+        e.g. to reprint a single damaged sheet. QR codes are computed by
+        processes worker processes (default: one per CPU, 1 to compute them
+        in place) while this process only draws.
+        """
+        layout = self.get_layout()
+        if pages is None:
+            pages = range(1, layout.pages + 1)
+        pages = list(pages)
+        for page in pages:
+            if not 1 <= page <= layout.pages:
+                raise ValueError("Invalid page: {} of {}".format(page, layout.pages))
+
+        with metrics.timer("document.render", pages=len(pages)):
+            self._render_pages(layout, pages, processes)
 
+    def _render_pages(self, layout, pages, processes):
         font_name = "Courier"
         font_size = 7
-        self.canvas.setFont(font_name, font_size)
-        self.canvas.setFillGray(.5)
         font_height = get_font_height(font_name, font_size)
-        page = 1
-        qx, qy = 0, 0
-        w0 = self.border_left
-        h0 = self.border_bottom + footer_height + vp_height
-        per_page = qrs_page1
-        on_page = 0
-        for part, title in self.all_qr():
-            on_page += 1
-            if on_page == 1 and page != 1:
-                self.canvas.showPage()
-                self.draw_header2(page, pages)
-            qr = qrcode.QRCode(border=0)
-            qr.add_data(part)
-            img = qr.make_image()
-            x = w0 + qx * (space + qw)
-            y = h0 - qy * qh
+        indices = [n for page in pages for n in layout.page_items(page)]
+        items = (layout.qr_item(n) for n in indices)
+        # time spent waiting for QR codes, all of the QR fitting with processes=1
+        matrices = metrics.iter_timed("document.qr_codes", iter_qr_matrices(items, processes), "qr_symbols")
+        current = None
+        for n, (part, title, matrix) in zip(indices, matrices):
+            page, x, y = layout.position(n)
+            if page != current:
+                if current is not None:
+                    self.canvas.showPage()
+                if page == 1:
+                    self.draw_header(page, layout.pages)
+                    self.canvas.setFont(font_name, font_size)
+                    self.canvas.setFillGray(.5)
+                else:
+                    # also restores font and fill for the QR titles
+                    self.draw_header2(page, layout.pages)
+                current = page
             self.canvas.drawString(x, y - font_height, title)
             y -= font_height * 1.8
-            self.canvas.drawInlineImage(img,
-                                 x, y - qw,
-                                 width=qw, height=qw)
-            qx += 1
-            if qx >= per_row:
-                qx = 0
-                qy += 1
-            if on_page == per_page:
-                if page == 1:
-                    per_page = qrs_page2
-                    h0 = self.border_bottom + footer_height + vp_height2
-                on_page = 0
-                qy = 0
-                page += 1
+            if self.qr_mode == "vector":
+                draw_qr_vector(self.canvas, matrix, x, y - layout.qw, layout.qw)
+            else:
+                self.canvas.drawInlineImage(qr_matrix_image(matrix),
+                                     x, y - layout.qw,
+                                     width=layout.qw, height=layout.qw)
 
         self.canvas.save()
+
+    def render_parallel(self, processes=None):
+        """
+        Render the document with pages split into contiguous ranges over
+        processes worker processes (default: one per CPU). Every worker writes
+        its pages into a PDF in memory, the fragments are concatenated into
+        the final document. Needs pypdf.
+        """
+        # only needed here, so it stays an optional dependency
+        from pypdf import PdfReader, PdfWriter
+
+        layout = self.get_layout()
+        if processes is None:
+            processes = os.cpu_count() or 1
+        pages = list(range(1, layout.pages + 1))
+        chunks = min(len(pages), processes * 2)
+        ranges = [pages[i * len(pages) // chunks:(i + 1) * len(pages) // chunks]
+                  for i in range(chunks)]
+        # stages run in the workers are not seen by metrics of this process
+        with metrics.timer("document.render_parallel", pages=len(pages)):
+            writer = PdfWriter()
+            with concurrent.futures.ProcessPoolExecutor(
+                    processes, initializer=_init_page_worker, initargs=(self.pu, self.qr_mode)) as pool:
+                for fragment in pool.map(render_pages_pdf, ranges):
+                    writer.append(PdfReader(io.BytesIO(fragment)))
+            if isinstance(self.file_name, str):
+                with open(self.file_name, "wb") as f:
+                    writer.write(f)
+            else:
+                writer.write(self.file_name)
+
+
+class PapupLayout:
+    """
+    Layout plan of a PapupDocument: how many QR codes there are, how many fit
+    on the first and on the following pages, and where each of them goes.
+    """
+
+    def __init__(self, doc):
+        pu = doc.pu
+        self.ident = pu.ident
+        self.part_size = pu.part_size
+        self.header_json = json.dumps(pu.get_header())
+        self.header_count = int(math.ceil(len(self.header_json) / pu.part_size))
+        # how many qrs do we have:
+        self.total = self.header_count + pu.part_count
+        self.pu = pu
+        # calculate view port for page 1:
+        header_height = doc.header_height()
+        footer_height = doc.footer_height()
+        vp_height = doc.page_size[1] - header_height - footer_height - doc.border_top - doc.border_bottom
+        self.space = QR_SPACE
+        self.per_row = QR_PER_ROW
+        # calculate qr code size:
+        self.x0, _, self.qw = qr_grid(doc.page_size, doc.border_left, doc.border_right)
+        self.qh = self.qw + 0.7 * cm
+        per_col = int((vp_height + 0.7 * cm) // self.qh)
+        self.qrs_page1 = self.per_row * per_col
+        # calculate view port for page 2:
+        vp_height2 = doc.page_size[1] - doc.header2_height() - footer_height - doc.border_top - doc.border_bottom
+        per_col2 = int((vp_height2 + 0.7 * cm) // self.qh)
+        self.qrs_page2 = self.per_row * per_col2
+        if self.total <= self.qrs_page1:
+            self.pages = 1
+        else:
+            self.pages = 1 + int(math.ceil((self.total - self.qrs_page1) / self.qrs_page2))
+        self.h0_page1 = doc.border_bottom + footer_height + vp_height
+        self.h0_page2 = doc.border_bottom + footer_height + vp_height2
+
+    def locate(self, n):
+        """Page (starting at 1), column and row of QR code n (starting at 0)."""
+        if not 0 <= n < self.total:
+            raise IndexError(n)
+        if n < self.qrs_page1:
+            page, on_page = 1, n
+        else:
+            page, on_page = divmod(n - self.qrs_page1, self.qrs_page2)
+            page += 2
+        qy, qx = divmod(on_page, self.per_row)
+        return page, qx, qy
+
+    def position(self, n):
+        """Page and top left corner (title line included) of QR code n."""
+        page, qx, qy = self.locate(n)
+        h0 = self.h0_page1 if page == 1 else self.h0_page2
+        return page, self.x0 + qx * (self.space + self.qw), h0 - qy * self.qh
+
+    def page_items(self, page):
+        """Range of the QR codes on page."""
+        if page == 1:
+            return range(0, min(self.qrs_page1, self.total))
+        start = self.qrs_page1 + (page - 2) * self.qrs_page2
+        return range(start, min(start + self.qrs_page2, self.total))
+
+    def qr_item(self, n):
+        """(data, title) of QR code n, header (PUM) codes first, then the parts."""
+        if n < self.header_count:
+            title = f"PUM:{self.ident}:{n+1}/{self.header_count}"
+            data = title + ":" + self.header_json[n*self.part_size:(n+1)*self.part_size]
+            return data, title
+        n -= self.header_count - 1
+        title = self.pu.part_title(n)
+        return title + ":" + self.pu.encode_part(self.pu.get_part(n)), title
+
+    def part_page(self, part):
+        """Page holding data part number part (starting at 1)."""
+        return self.locate(self.header_count + part - 1)[0]
@@ -1,11 +1,56 @@
 import math
 import mimetypes
+import mmap
 import os.path
 import string
+import struct
 import random
 import time
 from hashlib import sha256
 
+# RFC 9285, every character is in the QR alphanumeric set
+BASE45_CHARSET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:"
+_BASE45_TRIPLETS = None
+_BASE45_VALUES = None
+
+
+def _base45_triplets():
+    # the three characters for every two byte value, built on first use
+    global _BASE45_TRIPLETS
+    if _BASE45_TRIPLETS is None:
+        c = BASE45_CHARSET
+        _BASE45_TRIPLETS = [c[n % 45] + c[n // 45 % 45] + c[n // 2025] for n in range(65536)]
+    return _BASE45_TRIPLETS
+
+
+def base45_encode(data):
+    data = bytes(data)
+    even = len(data) - len(data) % 2
+    words = struct.unpack(f">{even // 2}H", data[:even])
+    text = "".join(map(_base45_triplets().__getitem__, words))
+    if even < len(data):
+        text += BASE45_CHARSET[data[-1] % 45] + BASE45_CHARSET[data[-1] // 45]
+    return text
+
+
+def base45_decode(text):
+    global _BASE45_VALUES
+    if _BASE45_VALUES is None:
+        _BASE45_VALUES = {t: struct.pack(">H", n) for n, t in enumerate(_base45_triplets())}
+    full = len(text) - len(text) % 3
+    try:
+        data = b"".join(map(_BASE45_VALUES.__getitem__, (text[i:i + 3] for i in range(0, full, 3))))
+        if full < len(text):
+            if len(text) - full != 2:
+                raise ValueError("Invalid base45 length: {}".format(len(text)))
+            n = BASE45_CHARSET.index(text[full]) + BASE45_CHARSET.index(text[full + 1]) * 45
+            if n > 255:
+                raise ValueError("Invalid base45 data")
+            data += bytes((n,))
+    except KeyError as e:
+        raise ValueError("Invalid base45 data: {}".format(e))
+    return data
+
 
 def crc16(data: bytes):
     xor_in = 0x0000  # initial value
@@ -27,8 +72,29 @@ def crc16(data: bytes):
     return reg ^ xor_out
 
 
+class FrozenDigest:
+    """The result of a finished hash object, which unlike the object can be pickled."""
+
+    def __init__(self, digest):
+        self.name = digest.name
+        self._digest = digest.digest()
+
+    def digest(self):
+        return self._digest
+
+    def hexdigest(self):
+        return self._digest.hex()
+
+
 class PapupFile:
     PART_SIZE = 128
+    HASH_CHUNK_SIZE = 1024 * 1024
+    # part encoding -> (QR code tag, part size); both part sizes end up in
+    # QR codes of the same version
+    PART_ENCODINGS = {
+        "hex": ("PUD", 128),
+        "base45": ("PUE", 192),
+    }
 
     @staticmethod
     def gen_id(length=4):
@@ -43,20 +109,81 @@ class PapupFile:
         p.mime = mimetypes.guess_type(path)
         return p
 
-    def __init__(self, filename, data):
+    @staticmethod
+    def map(path):
+        """
+        Like load, but the file is memory mapped instead of read into memory,
+        get_part returns memoryview slices of the mapping. Length comes from
+        os.stat and sha256 is computed in a single streaming pass.
+        """
+        filename = os.path.basename(path)
+        length = os.stat(path).st_size
+        digest = sha256()
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(PapupFile.HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+            data = PapupFile._map_data(f, length)
+        p = PapupFile(filename, data, length=length, digest=digest)
+        p.mime = mimetypes.guess_type(path)
+        p.path = os.path.abspath(path)
+        return p
+
+    @staticmethod
+    def _map_data(f, length):
+        # empty files cannot be mapped
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if length else b"")
+
+    def __init__(self, filename, data, length=None, digest=None):
         self.filename = filename
         self.ident = PapupFile.gen_id()
         if type(data) == str:
             self.data = data.encode("utf-8")
         else:
             self.data = data
-        self.length = len(data)
+        self.length = len(self.data) if length is None else length
         self.part_size = PapupFile.PART_SIZE
-        self.sha256 = sha256(data)
+        self.encoding = "hex"
+        self.part_tag = "PUD"
+        self.sha256 = sha256(self.data) if digest is None else digest
         self.date = time.time()
         self.description = ""
         self.part_count = int(math.ceil(self.length / self.part_size))
         self.mime = None
+        # file the data is mapped from, see map
+        self.path = None
+
+    def __getstate__(self):
+        # for worker processes: hash objects and memoryviews cannot be
+        # pickled, a mapped file is mapped again from its path
+        state = self.__dict__.copy()
+        state["sha256"] = FrozenDigest(self.sha256)
+        if isinstance(self.data, memoryview):
+            state["data"] = None if self.path else bytes(self.data)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.data is None:
+            with open(self.path, "rb") as f:
+                if os.fstat(f.fileno()).st_size != self.length:
+                    raise ValueError("File changed: {}".format(self.path))
+                self.data = PapupFile._map_data(f, self.length)
+
+    def set_encoding(self, encoding, part_size=None):
+        """
+        Select how parts are encoded in the QR codes: "hex" (the default) or
+        the denser "base45", which stays in QR alphanumeric mode. Raw byte mode
+        is not offered, as zbar converts binary QR content to text.
+        """
+        if encoding not in PapupFile.PART_ENCODINGS:
+            raise ValueError("Invalid part encoding: {}".format(encoding))
+        self.encoding = encoding
+        self.part_tag, default_size = PapupFile.PART_ENCODINGS[encoding]
+        self.part_size = part_size or default_size
+        self.part_count = int(math.ceil(self.length / self.part_size))
 
     def get_header(self):
         return {
@@ -68,8 +195,17 @@ class PapupFile:
             "name": self.filename,
             "description": self.description,
             "mime": self.mime[0] if self.mime else "",
+            "encoding": self.encoding,
         }
 
+    def close(self):
+        """Release the mapping of a file opened with map."""
+        if isinstance(self.data, memoryview):
+            obj = self.data.obj
+            self.data.release()
+            if isinstance(obj, mmap.mmap):
+                obj.close()
+
     def get_part(self, n):
         return self.data[(n - 1) * self.part_size:n * self.part_size]
 
@@ -77,12 +213,20 @@ class PapupFile:
         for n in range(self.part_count):
             yield self.get_part(n+1)
 
+    def encode_part(self, part):
+        if self.encoding == "base45":
+            return base45_encode(part)
+        return bytes(part).hex().upper()
+
+    def part_title(self, n):
+        return f"{self.part_tag}:{self.ident}:{n}/{self.part_count}"
+
     def qr_parts(self):
-        for n in range(self.part_count):
-            yield f"PUD:{self.ident}:{n+1}/{self.part_count}:" + "".join("%02X" % c for c in self.get_part(n+1))
+        for part, title in self.qr_parts_with_title():
+            yield part
 
     def qr_parts_with_title(self):
         for n in range(self.part_count):
-            title = f"PUD:{self.ident}:{n+1}/{self.part_count}"
-            qr_part = title + ":" + ("".join("%02X" % c for c in self.get_part(n+1)))
+            title = self.part_title(n+1)
+            qr_part = title + ":" + self.encode_part(self.get_part(n+1))
             yield qr_part, title
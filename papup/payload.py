@@ -4,54 +4,395 @@ Created on Jan 4, 2017
 @author: kratenko
 """
 
+import bisect
+import collections
+import concurrent.futures
 import hashlib
 import bz2
+import io
+import itertools
+import logging
+import lzma
+import math
+import os
 import struct
-import unireedsolomon
-
-
-def iterate_chunks(l, n):
-    """Yield successive n-sized chunks from l."""
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
-
-
-def rs_encode_data(n, k, data, pad_byte=b"\x55"):
-    rs = unireedsolomon.RSCoder(n, k)
-    chunks = []
-    for chunk in iterate_chunks(data, k):
-        if len(chunk) < k:
-            # pad short chunks with \0 at end
-            # this only happens for the last chunk
-            pad = k - len(chunk)
-            chunk += pad_byte * pad
-        chunks.append(rs.encode(chunk).encode("L1"))
-    return b"".join(chunks), pad
-
-
-def rs_decode_data(n, k, data, length=None):
-    rs = unireedsolomon.RSCoder(n, k)
-    chunks = []
-    for chunk in iterate_chunks(data[:-1], n):
-        chunks.append(rs.decode(chunk)[0].encode("L1"))
-    # concat:
-    joined = b"".join(chunks)
+import time
+import zlib
+
+from papup import metrics
+from papup.reedsolomon import get_codec, ReedSolomonError, RSDecodeReport
+
+logger = logging.getLogger(__name__)
+
+FILL_BYTE = b"\x55"
+
+
+def rs_encode_data(n, k, data, pad_byte=FILL_BYTE):
+    # pad short last chunk at end, all chunks are encoded in one go
+    pad = -len(data) % k
+    return get_codec(n, k).encode(data + pad_byte * pad), pad
+
+
+def rs_decode_data(n, k, data, length=None, report=False, processes=None, erasures=None):
+    """
+    Decode RS(n, k) codewords. Only damaged codewords are actually corrected,
+    see RSCodec.decode. erasures are offsets in data of bytes known to be bad
+    (see paper.erasures_from_blocks). Raises ReedSolomonError if a codeword
+    cannot be repaired, unless report is set: then (data, RSDecodeReport) is
+    returned and the caller has to look at report.failed.
+    """
+    joined, rs_report = get_codec(n, k).decode(
+        data, erasures=erasures, processes=processes)
     # include optionally cutting the padding for convenience:
-    if length is None:
-        return joined
+    if length is not None:
+        joined = joined[:length]
+    if report:
+        return joined, rs_report
+    if rs_report.failed:
+        raise ReedSolomonError(
+            "Uncorrectable codewords: {}".format(rs_report.failed))
+    return joined
+
+
+# redundancy level -> RS(n, k) code used on the payload
+REDUNDANCY_CODES = {
+    # 0 -> no redundancy
+    0: None,
+    # 1 -> 8 in 255 bytes
+    1: (255, 247),
+    # 2 -> 16 in 255 bytes
+    2: (255, 239),
+    # 3 -> 32 in 255 bytes (common standard)
+    3: (255, 223),
+    # 4 -> 64 in 255 bytes
+    4: (255, 191),
+    # 5 -> 128 in 255 bytes
+    5: (255, 127),
+}
+# flag in the redundancy byte of the payload header: the codewords of every
+# batch of RS_BATCH_CODEWORDS (the last batch takes the rest as well, up to
+# twice as many) are interleaved byte by byte, so a block that fails its CRC
+# erases a byte or so of many codewords instead of dozens of bytes of one or
+# two; payloads without it have the codewords in a row
+REDUNDANCY_INTERLEAVED = 0x80
+
+
+# compression method -> name; the method is the compression byte of the
+# payload header, so a payload tells how to decompress it
+COMPRESSION_METHODS = {
+    0: "store",
+    1: "bz2",
+    2: "zlib",
+    3: "xz",
+}
+# level used when none is given: 1-9 for bz2 and zlib, xz presets 0-9,
+# optionally or-ed with lzma.PRESET_EXTREME. Decoding does not need it.
+COMPRESSION_DEFAULT_LEVELS = {1: 9, 2: 9, 3: 6}
+# compression="auto" picks method and level per content, see choose_compression
+COMPRESSION_AUTO = "auto"
+# (method, level) auto chooses from; higher xz presets need hundreds of MB
+AUTO_CANDIDATES = [(0, None), (2, 6), (2, 9), (1, 9), (3, 6)]
+# bytes of content auto compresses with every candidate: all of it if no
+# more, else AUTO_SAMPLE_PIECES pieces spread over it (see read_spread_sample),
+# so repetition over long distances shows in the sample
+AUTO_SAMPLE_SIZE = 1024 * 1024
+AUTO_SAMPLE_PIECES = 8
+# flag in the compression byte of the payload header: the content was cut
+# into blocks compressed as independent streams, each behind a frame
+# header with its compressed and raw size, so they can be decompressed in
+# parallel
+COMPRESSION_MULTI_STREAM = 0x80
+COMPRESSION_FRAME = struct.Struct("!LL")
+# content bytes per stream; bz2 works in blocks of 900 kB anyway, xz needs
+# larger ones to lose little against a single stream
+MULTI_STREAM_BLOCK_SIZES = {1: 900 * 1000, 2: 1024 * 1024, 3: 4 * 1024 * 1024}
+
+
+class ZlibDecompressor:
+    """zlib.decompressobj with the interface of the bz2 and lzma decompressors."""
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj()
+
+    @property
+    def eof(self):
+        return self.decompressor.eof
+
+    @property
+    def needs_input(self):
+        return not self.decompressor.unconsumed_tail
+
+    def decompress(self, data, max_length=-1):
+        if self.decompressor.unconsumed_tail:
+            data = self.decompressor.unconsumed_tail + data
+        return self.decompressor.decompress(data, max(max_length, 0))
+
+
+def make_compressor(method, level=None):
+    """Compressor object (with compress and flush) for a compression method but store."""
+    if level is None:
+        level = COMPRESSION_DEFAULT_LEVELS.get(method)
+    if method == 1:
+        return bz2.BZ2Compressor(level)
+    elif method == 2:
+        return zlib.compressobj(level)
+    elif method == 3:
+        # the payload has its own checksum
+        return lzma.LZMACompressor(lzma.FORMAT_XZ, check=lzma.CHECK_NONE, preset=level)
+    raise ValueError("Invalid compression method: {}".format(method))
+
+
+def make_decompressor(method):
+    if method == 1:
+        return bz2.BZ2Decompressor()
+    elif method == 2:
+        return ZlibDecompressor()
+    elif method == 3:
+        return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+    raise ValueError("Invalid compression method: {}".format(method))
+
+
+def compress_block(method, level, data):
+    """A block compressed as an independent stream, behind its frame header."""
+    compressor = make_compressor(method, level)
+    compressed = compressor.compress(data) + compressor.flush()
+    return COMPRESSION_FRAME.pack(len(compressed), len(data)) + compressed
+
+
+def decompress_block(method, data, raw_size):
+    decompressor = make_decompressor(method)
+    raw = decompressor.decompress(data)
+    if not decompressor.eof or len(raw) != raw_size:
+        raise ValueError("Corrupt compressed stream")
+    return raw
+
+
+def iter_blocks(chunks, size):
+    """Join chunks into blocks of size bytes, the last one may be shorter."""
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= size:
+            yield bytes(buf[:size])
+            del buf[:size]
+    if buf:
+        yield bytes(buf)
+
+
+def iter_frames(chunks):
+    """Yield (stream, raw size) for the framed streams in chunks."""
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= COMPRESSION_FRAME.size:
+            size, raw_size = COMPRESSION_FRAME.unpack_from(buf)
+            end = COMPRESSION_FRAME.size + size
+            if len(buf) < end:
+                break
+            yield bytes(buf[COMPRESSION_FRAME.size:end]), raw_size
+            del buf[:end]
+    if buf:
+        raise ValueError("Truncated compressed data")
+
+
+def iter_parallel(function, args, processes=None):
+    """
+    Yield function(*a) for every tuple a of args, in order. Calls run in a
+    process pool (processes: default one per CPU, 1 to call in place) ahead
+    of the consumer, at most two per process, so memory stays flat.
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes <= 1:
+        for a in args:
+            yield function(*a)
+        return
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        pending = collections.deque()
+        for a in args:
+            pending.append(pool.submit(function, *a))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def choose_compression(sample, content_size=None, budget=None, count_pages=None, code=None):
+    """
+    Pick (method, level) from AUTO_CANDIDATES for content starting with
+    sample. Candidates needing more than budget CPU seconds per MB on the
+    sample are left out, the one with the smallest output wins, counted in
+    pages by count_pages(payload size) if given, with the RS code (n, k)
+    applied if given; ties go to the faster one. content_size, if known,
+    scales the sample results up to the whole content.
+    """
+    scale = content_size / len(sample) if content_size and sample else 1
+    best = None
+    for method, level in AUTO_CANDIDATES:
+        t0 = time.process_time()
+        if method == 0:
+            size = len(sample)
+        else:
+            compressor = make_compressor(method, level)
+            size = len(compressor.compress(sample)) + len(compressor.flush())
+        seconds = time.process_time() - t0
+        if method and budget is not None and sample and seconds / len(sample) * 1e6 > budget:
+            continue
+        # plus the payload header and two empty meta blocks
+        size = size * scale + 4
+        if code is not None:
+            size = math.ceil(size / code[1]) * code[0]
+        size += PAYLOAD_HEADER_SIZE
+        cost = count_pages(int(size)) if count_pages else size
+        if best is None or (cost, seconds) < best[:2]:
+            best = (cost, seconds, method, level)
+    return best[2], best[3]
+
+
+def read_sample(chunks, size):
+    """The first size bytes of chunks (or all) and an iterator over the chunks left."""
+    it = iter(chunks)
+    sample = bytearray()
+    for chunk in it:
+        sample += chunk
+        if len(sample) >= size:
+            break
+    return bytes(sample), it
+
+
+def read_spread_sample(source, content_size, size=AUTO_SAMPLE_SIZE, pieces=AUTO_SAMPLE_PIECES):
+    """
+    Sample of source (file-like or bytes-like) for auto: all content_size
+    bytes if no more than size, else pieces of size / pieces bytes evenly
+    spread over them. A file is read at random and left where it was. None
+    if source cannot be read that way (e.g. a pipe).
+    """
+    if content_size is None:
+        return None
+    if content_size <= size:
+        piece, offsets = content_size, [0]
+    else:
+        piece = size // pieces
+        offsets = [i * (content_size - piece) // (pieces - 1) for i in range(pieces)]
+    if not hasattr(source, "read"):
+        view = memoryview(source)
+        return b"".join(view[o:o + piece] for o in offsets)
+    try:
+        start = source.tell()
+        parts = []
+        for o in offsets:
+            source.seek(start + o)
+            parts.append(source.read(piece))
+        source.seek(start)
+    except (AttributeError, OSError):
+        return None
+    return b"".join(parts)
+
+
+def source_size(source):
+    """Bytes left in source (file-like or bytes-like), None if unknown."""
+    if hasattr(source, "read"):
+        try:
+            return os.fstat(source.fileno()).st_size - source.tell()
+        except (AttributeError, OSError):
+            return None
+    return memoryview(source).nbytes
+
+
+# bytes read from the source per step when streaming
+STREAM_CHUNK_SIZE = 64 * 1024
+# codewords encoded per batch when streaming
+RS_BATCH_CODEWORDS = 256
+PAYLOAD_HEADER_SIZE = 32
+
+
+def interleave(data, n):
+    """Codewords of n bytes in data interleaved: byte j of codeword i goes to j * count + i."""
+    count = len(data) // n
+    out = bytearray(len(data))
+    for i in range(count):
+        out[i::count] = data[i * n:(i + 1) * n]
+    return out
+
+
+def deinterleave(data, n):
+    """Counterpart of interleave, the codewords back in a row."""
+    count = len(data) // n
+    out = bytearray(len(data))
+    for i in range(count):
+        out[i * n:(i + 1) * n] = data[i::count]
+    return out
+
+
+def iterate_source(source, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield chunks of a file-like object (with read) or bytes-like object."""
+    if hasattr(source, "read"):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
     else:
-        return joined[:length]
+        view = memoryview(source)
+        for i in range(0, len(view), chunk_size):
+            yield view[i:i + chunk_size]
+
+
+def iter_split_meta(chunks, meta):
+    """
+    Strip a length prefixed meta block ("!H" size followed by the data) from
+    the front of chunks and yield the rest. The meta data is appended to the
+    bytearray meta.
+    """
+    head = bytearray()
+    need = None
+    for chunk in chunks:
+        chunk = memoryview(chunk)
+        if need is None:
+            take = 2 - len(head)
+            head += chunk[:take]
+            chunk = chunk[take:]
+            if len(head) < 2:
+                continue
+            need, = struct.unpack("!H", head)
+        if need:
+            part = chunk[:need]
+            meta += part
+            need -= len(part)
+            chunk = chunk[len(part):]
+        if chunk:
+            yield chunk
+    if need is None or need:
+        raise ValueError("Truncated meta data")
 
 
 class PapupPayload:
 
-    def __init__(self, redundancy=3, compression=1, encryption=0):
+    def __init__(self, redundancy=3, compression=1, encryption=0, compression_level=None,
+                 compression_budget=None, count_pages=None, multi_stream=False):
+        """
+        compression is a method of COMPRESSION_METHODS or COMPRESSION_AUTO,
+        compression_level is passed to the compressor (default: see
+        COMPRESSION_DEFAULT_LEVELS). For auto, compression_budget limits the
+        CPU seconds per MB spent compressing and count_pages tells the pages
+        a payload size needs, see choose_compression. multi_stream
+        compresses blocks as independent streams in parallel, see
+        COMPRESSION_MULTI_STREAM.
+        """
         self.data = None
         # payload header data:
         self.payload_size = None
         self.redundancy = redundancy
         self.redundancy_padding = 0
+        # codewords interleaved, see REDUNDANCY_INTERLEAVED
+        self.interleaved = True
         self.compression = compression
+        self.compression_level = compression_level
+        self.compression_budget = compression_budget
+        self.count_pages = count_pages
+        self.multi_stream = multi_stream
+        # bytes of content to pack, if known, for auto
+        self.content_size = None
         self.compression_padding = 0
         self.encryption = encryption
         self.encryption_padding = 0
@@ -67,87 +408,347 @@ class PapupPayload:
         self.raw_data_sha1 = hashlib.sha1(self.data)
 
     def pack_payload(self):
-        self.do_crypt_meta()
-        self.do_compression()
-        self.do_encryption()
-        self.do_clear_meta()
-        self.do_redundancy()
-        self.do_payload_header()
+        """Pack the content set with set_content, result is in self.data."""
+        out = io.BytesIO()
+        self.pack_to(out, self.data)
+        self.data = out.getvalue()
 
-    def do_compression(self):
+    def pack_to(self, out, source, processes=None):
+        """
+        Pack content from source (file-like or bytes-like) into the seekable
+        file-like out, chunk by chunk with constant memory. The payload
+        header is written as a placeholder first and patched at the end.
+        processes compress the streams of a multi_stream payload. Returns
+        the total number of bytes written.
+        """
+        start = out.tell()
+        out.write(b"\0" * PAYLOAD_HEADER_SIZE)
+        for chunk in self.iter_pack(source, processes):
+            out.write(chunk)
+        end = out.tell()
+        out.seek(start)
+        out.write(self.payload_header)
+        out.seek(end)
+        return end - start
+
+    def iter_pack(self, source, processes=None):
+        """
+        Yield the packed payload data (everything after the payload header)
+        in chunks. When exhausted, self.payload_header is set.
+        """
+        self.payload_size = 0
+        self.content_size = source_size(source)
+        if self.compression == COMPRESSION_AUTO:
+            sample = read_spread_sample(source, self.content_size)
+            if sample is not None:
+                self.choose_compression(sample)
+        chunks = self.iter_content(iterate_source(source))
+        chunks = self.iter_crypt_meta(chunks)
+        chunks = metrics.iter_stage(
+            "payload.compression", lambda c: self.iter_compression(c, processes), chunks)
+        chunks = metrics.iter_stage("payload.encryption", self.iter_encryption, chunks)
+        chunks = self.iter_clear_meta(chunks)
+        chunks = metrics.iter_stage("payload.redundancy", self.iter_redundancy, chunks)
+        for chunk in chunks:
+            self.payload_size += len(chunk)
+            yield chunk
+        self.generate_payload_header()
+
+    def iter_content(self, chunks):
+        self.raw_data_length = 0
+        self.raw_data_sha1 = hashlib.sha1()
+        for chunk in chunks:
+            self.raw_data_length += len(chunk)
+            self.raw_data_sha1.update(chunk)
+            yield chunk
+
+    def iter_crypt_meta(self, chunks):
+        if self.crypt_meta_data is None:
+            self.crypt_meta_size = 0
+            yield struct.pack("!H", self.crypt_meta_size)
+        else:
+            self.crypt_meta_size = len(self.crypt_meta_data)
+            yield struct.pack("!H", self.crypt_meta_size) + self.crypt_meta_data
+        yield from chunks
+
+    def choose_compression(self, sample):
+        """Resolve compression auto to the method and level picked on sample."""
+        self.compression, self.compression_level = choose_compression(
+            sample, self.content_size, self.compression_budget,
+            self.count_pages, REDUNDANCY_CODES.get(self.redundancy))
+        logger.info("auto picked %s level %s on a %d byte sample",
+                    COMPRESSION_METHODS[self.compression], self.compression_level, len(sample))
+
+    def iter_compression(self, chunks, processes=None):
+        if self.compression == COMPRESSION_AUTO:
+            # source not readable at random, sample the head of the stream
+            sample, chunks = read_sample(chunks, AUTO_SAMPLE_SIZE)
+            self.choose_compression(sample)
+            chunks = itertools.chain([sample], chunks)
         if self.compression == 0:
             # no compression
-            print("no compression")
-            pass
-        elif self.compression == 1:
-            # bz2, 9
-            print("bz2 compression")
-            self.data = bz2.compress(self.data)
-        else:
-            raise ValueError(
-                "Invalid compression method: {}".format(self.compression))
+            logger.info("no compression")
+            yield from chunks
+            return
+        if self.multi_stream:
+            logger.info("%s compression, multi-stream", COMPRESSION_METHODS[self.compression])
+            # fail on a bad method or level here, not in a worker
+            make_compressor(self.compression, self.compression_level)
+            blocks = iter_blocks(chunks, MULTI_STREAM_BLOCK_SIZES[self.compression])
+            yield from iter_parallel(
+                compress_block, ((self.compression, self.compression_level, b) for b in blocks), processes)
+            return
+        compressor = make_compressor(self.compression, self.compression_level)
+        logger.info("%s compression", COMPRESSION_METHODS[self.compression])
+        for chunk in chunks:
+            c = compressor.compress(chunk)
+            if c:
+                yield c
+        yield compressor.flush()
 
-    def do_encryption(self):
+    def iter_encryption(self, chunks):
         if self.encryption == 0:
             # no encryption
-            pass
+            yield from chunks
         else:
             raise ValueError(
                 "Invalid encryption method: {}".format(self.encryption))
 
-    def do_redundancy(self):
-        if self.redundancy == 0:
+    def iter_clear_meta(self, chunks):
+        if self.clear_meta_data is None:
+            self.clear_meta_size = 0
+            yield struct.pack("!H", self.clear_meta_size)
+        else:
+            self.clear_meta_size = len(self.clear_meta_data)
+            yield struct.pack("!H", self.clear_meta_size) + self.clear_meta_data
+        yield from chunks
+
+    def iter_redundancy(self, chunks):
+        if self.redundancy not in REDUNDANCY_CODES:
+            raise ValueError(
+                "Invalid redundancy method: {}".format(self.redundancy))
+        code = REDUNDANCY_CODES[self.redundancy]
+        if code is None:
             # 0 -> no redundancy
             self.redundancy_padding = 0
-        elif self.redundancy == 1:
-            # 1 -> 8 in 255 bytes
-            self.data, self.redundancy_padding = rs_encode_data(
-                255, 247, self.data)
-        elif self.redundancy == 1:
-            # 2 -> 16 in 255 bytes:
-            self.data, self.redundancy_padding = rs_encode_data(
-                255, 239, self.data)
-        elif self.redundancy == 3:
-            # 3 -> 32 in 255 bytes (common standard):
-            self.data, self.redundancy_padding = rs_encode_data(
-                255, 223, self.data)
-        elif self.redundancy == 4:
-            # 4 -> 64 in 255 bytes:
-            self.data, self.redundancy_padding = rs_encode_data(
-                255, 191, self.data)
-        elif self.redundancy == 5:
-            # 5 -> 128 in 255 bytes:
-            self.data, self.redundancy_padding = rs_encode_data(
-                255, 127, self.data)
-        else:
+            yield from chunks
+            return
+        n, k = code
+        codec = get_codec(n, k)
+        batch = k * RS_BATCH_CODEWORDS
+        buf = bytearray()
+        codewords = 0
+        for chunk in chunks:
+            buf += chunk
+            # the last whole batch is held back: it takes the codewords
+            # left at the end, so no batch is interleaved over only a few
+            # codewords (see iter_rs_batches)
+            cut = max(0, len(buf) // batch - 1) * batch
+            for start in range(0, cut, batch):
+                yield self.arrange_codewords(codec.encode(buf[start:start + batch]), n)
+            codewords += cut // k
+            del buf[:cut]
+        # last batch, with the short last chunk padded at its end
+        self.redundancy_padding = -len(buf) % k
+        if buf:
+            yield self.arrange_codewords(codec.encode(bytes(buf) + FILL_BYTE * self.redundancy_padding), n)
+            codewords += (len(buf) + self.redundancy_padding) // k
+        if metrics.enabled():
+            metrics.record("payload.redundancy", codewords=codewords)
+
+    def arrange_codewords(self, data, n):
+        return interleave(data, n) if self.interleaved else data
+
+    def unpack_payload(self, data, sha1=None, erasures=None):
+        """In memory counterpart of pack_payload, the content ends up in self.data."""
+        out = io.BytesIO()
+        self.unpack_to(out, data, sha1, erasures)
+        self.data = out.getvalue()
+
+    def unpack_to(self, out, data, sha1=None, erasures=None, processes=None):
+        """
+        Unpack a complete payload (payload header included) from the
+        bytes-like data (bytes, mmap, ...) and write the content to out.
+        Header fields are read into this object. Layers are parsed through
+        memoryviews and decompressed incrementally. If given, the sha1 hex
+        digest of the content is verified. erasures are offsets of bytes in
+        data known to be bad. Returns the number of bytes written.
+        """
+        view = memoryview(data)
+        erasures = sorted(erasures or ())
+        self.read_payload_header(
+            view[:PAYLOAD_HEADER_SIZE],
+            [e for e in erasures if e < PAYLOAD_HEADER_SIZE])
+        body = view[PAYLOAD_HEADER_SIZE:PAYLOAD_HEADER_SIZE + self.payload_size]
+        if len(body) < self.payload_size:
+            raise ValueError("Truncated payload: {} of {} bytes".format(
+                len(body), self.payload_size))
+        erasures = [e - PAYLOAD_HEADER_SIZE for e in erasures
+                    if e >= PAYLOAD_HEADER_SIZE]
+        clear_meta = bytearray()
+        crypt_meta = bytearray()
+        # iter_rs_decode works on the whole body, handed over as the only chunk
+        chunks = metrics.iter_stage(
+            "payload.rs_decode", lambda c: self.iter_rs_decode(next(iter(c)), erasures, processes), [body])
+        chunks = iter_split_meta(chunks, clear_meta)
+        chunks = metrics.iter_stage("payload.decryption", self.iter_decryption, chunks)
+        chunks = metrics.iter_stage(
+            "payload.decompression", lambda c: self.iter_decompression(c, processes), chunks)
+        chunks = iter_split_meta(chunks, crypt_meta)
+        for chunk in self.iter_content(chunks):
+            out.write(chunk)
+        self.clear_meta_size = len(clear_meta)
+        self.clear_meta_data = bytes(clear_meta) if clear_meta else None
+        self.crypt_meta_size = len(crypt_meta)
+        self.crypt_meta_data = bytes(crypt_meta) if crypt_meta else None
+        if sha1 is not None and self.raw_data_sha1.hexdigest() != sha1:
+            raise ValueError("Content sha1 mismatch: {} != {}".format(
+                self.raw_data_sha1.hexdigest(), sha1))
+        return self.raw_data_length
+
+    def read_payload_header(self, header, erasures=None):
+        raw, report = get_codec(32, 14).decode(header, erasures=erasures)
+        if report.failed:
+            raise ReedSolomonError("Payload header cannot be repaired")
+        (self.payload_size, self.redundancy, self.redundancy_padding,
+         self.encryption, self.encryption_padding, self.compression,
+         self.compression_padding) = struct.unpack("!QBBBBBB", raw)
+        self.interleaved = bool(self.redundancy & REDUNDANCY_INTERLEAVED)
+        self.redundancy &= ~REDUNDANCY_INTERLEAVED
+        self.multi_stream = bool(self.compression & COMPRESSION_MULTI_STREAM)
+        self.compression &= ~COMPRESSION_MULTI_STREAM
+        self.payload_header = bytes(header)
+
+    def iter_rs_decode(self, view, erasures=(), processes=None):
+        """
+        Yield the RS decoded data of view, batch by batch, with the padding
+        removed. The damaged codewords of the whole view are repaired before
+        the first batch, in one process pool (see RSCodec.repair).
+        Correction statistics are collected in self.rs_report.
+        """
+        if self.redundancy not in REDUNDANCY_CODES:
             raise ValueError(
                 "Invalid redundancy method: {}".format(self.redundancy))
+        code = REDUNDANCY_CODES[self.redundancy]
+        if code is None:
+            self.rs_report = None
+            yield view
+            return
+        n, k = code
+        if len(view) % n:
+            raise ValueError("Payload size {} is no multiple of {}".format(len(view), n))
+        codec = get_codec(n, k)
+        self.rs_report = RSDecodeReport(len(view) // n)
+        # find the damaged codewords of the whole body first (cheap), then
+        # repair them all in one go, so a process pool is only started once
+        damaged = []
+        codewords = []
+        for start, part, part_erasures in self.iter_rs_batches(view, n, erasures):
+            found = codec.find_damaged(part)
+            damaged.extend(start // n + i for i in found)
+            codewords.extend(codec.damaged_codewords(part, found, part_erasures))
+        repaired = {}
+        for i, (message, corrected) in zip(damaged, codec.repair(codewords, processes)):
+            if message is None:
+                self.rs_report.failed.append(i)
+            else:
+                repaired[i] = message
+                self.rs_report.corrected[i] = corrected
+        if self.rs_report.failed:
+            raise ReedSolomonError(
+                "Uncorrectable codewords: {}".format(self.rs_report.failed))
+        for start, part, _ in self.iter_rs_batches(view, n):
+            decoded = codec.messages(part)
+            first = start // n
+            for i in range(len(part) // n):
+                message = repaired.get(first + i)
+                if message is not None:
+                    decoded[i * k:(i + 1) * k] = message
+            if start + len(part) >= len(view) and self.redundancy_padding:
+                decoded = memoryview(decoded)[:len(decoded) - self.redundancy_padding]
+            yield decoded
+        if metrics.enabled():
+            metrics.record("payload.rs_decode", codewords=self.rs_report.codewords,
+                           corrected=len(self.rs_report.corrected))
 
-    def do_crypt_meta(self):
-        if self.crypt_meta_data is None:
-            self.crypt_meta_size = 0
-            d = struct.pack("!H", self.crypt_meta_size)
+    def iter_rs_batches(self, view, n, erasures=()):
+        """
+        Yield (start, codewords, erasures) for every batch of RS codewords in
+        view, deinterleaved if needed, with the erasures inside the batch as
+        offsets into the codewords. Batches have RS_BATCH_CODEWORDS
+        codewords, the last one takes the rest as well.
+        """
+        batch = n * RS_BATCH_CODEWORDS
+        batches = max(1, len(view) // batch) if len(view) else 0
+        for b in range(batches):
+            start = b * batch
+            part = view[start:start + batch] if b < batches - 1 else view[start:]
+            lo = bisect.bisect_left(erasures, start)
+            hi = bisect.bisect_left(erasures, start + len(part))
+            part_erasures = [e - start for e in erasures[lo:hi]]
+            if self.interleaved:
+                count = len(part) // n
+                part = deinterleave(part, n)
+                part_erasures = [e % count * n + e // count for e in part_erasures]
+            yield start, part, part_erasures
+
+    def iter_decryption(self, chunks):
+        if self.encryption == 0:
+            # no encryption
+            yield from chunks
         else:
-            self.crypt_meta_size = len(self.crypt_meta_data)
-            d = struct.pack("!H", self.crypt_meta_size) + self.crypt_meta_data
-        self.data = d + self.data
+            raise ValueError(
+                "Invalid encryption method: {}".format(self.encryption))
+
+    def iter_decompression(self, chunks, processes=None):
+        if self.compression == 0:
+            yield from chunks
+            return
+        decompressor = make_decompressor(self.compression)
+        if self.multi_stream:
+            yield from iter_parallel(
+                decompress_block, ((self.compression, stream, raw_size) for stream, raw_size in iter_frames(chunks)),
+                processes)
+            return
+        for chunk in chunks:
+            d = decompressor.decompress(chunk, STREAM_CHUNK_SIZE)
+            if d:
+                yield d
+            while not decompressor.needs_input and not decompressor.eof:
+                d = decompressor.decompress(b"", STREAM_CHUNK_SIZE)
+                if d:
+                    yield d
+        if not decompressor.eof:
+            raise ValueError("Truncated compressed data")
+
+    def do_compression(self):
+        self.data = b"".join(self.iter_compression([self.data]))
+
+    def do_encryption(self):
+        self.data = b"".join(self.iter_encryption([self.data]))
+
+    def do_redundancy(self):
+        self.data = b"".join(self.iter_redundancy([self.data]))
+
+    def do_crypt_meta(self):
+        self.data = b"".join(self.iter_crypt_meta([self.data]))
 
     def do_clear_meta(self):
-        if self.clear_meta_data is None:
-            self.clear_meta_size = 0
-            d = struct.pack("!H", self.clear_meta_size)
-        else:
-            self.clear_meta_size = len(self.clear_meta_data)
-            d = struct.pack("!H", self.clear_meta_size) + self.clear_meta_data
-        self.data = d + self.data
+        self.data = b"".join(self.iter_clear_meta([self.data]))
 
     def generate_payload_header(self):
-        self.payload_size = len(self.data)
-        header = struct.pack("!QBBBBBB", self.payload_size, self.redundancy, self.redundancy_padding,
-                             self.encryption, self.encryption_padding, self.compression, self.compression_padding)
-        rs = unireedsolomon.RSCoder(32, 14)
-        self.payload_header = rs.encode(header).encode("L1")
+        redundancy = self.redundancy
+        if self.interleaved and REDUNDANCY_CODES.get(redundancy) is not None:
+            redundancy |= REDUNDANCY_INTERLEAVED
+        compression = self.compression
+        if self.multi_stream and compression != 0:
+            compression |= COMPRESSION_MULTI_STREAM
+        header = struct.pack("!QBBBBBB", self.payload_size, redundancy, self.redundancy_padding,
+                             self.encryption, self.encryption_padding, compression, self.compression_padding)
+        self.payload_header = get_codec(32, 14).encode(header)
+        assert(len(self.payload_header) == PAYLOAD_HEADER_SIZE)
 
     def do_payload_header(self):
+        self.payload_size = len(self.data)
         self.generate_payload_header()
         self.data = self.payload_header + self.data
@@ -4,15 +4,14 @@ Created on Jan 3, 2017
 @author: kratenko
 """
 
+import collections
+import concurrent.futures
 import io
+import os
+import zlib
 
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image
-from reportlab.lib.styles import ParagraphStyle
-from reportlab.lib.units import cm
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.platypus.flowables import HRFlowable, PageBreak
+from papup import metrics
+from papup.geometry import A4, cm
 
 
 def wrap_pil_image(pil_image):
@@ -23,8 +22,174 @@ def wrap_pil_image(pil_image):
     return image_file
 
 
-def build_pdf(file, name):
-    pdfmetrics.registerFont(TTFont('DejaVuSansMono', 'DejaVuSansMono.ttf'))
+PAGE_MARGIN = 1 * cm
+LEGEND_FONT_SIZE = 10
+LEGEND_LEADING = 12
+IMAGE_COMPRESSION = 9
+
+
+def encode_page_image(pil_image):
+    """
+    Flate compressed 1-bit rows of a PIL "1" image. Set bits are white in
+    PIL as well as in a 1-bit DeviceGray PDF image, so rows are used as is.
+    """
+    return zlib.compress(pil_image.tobytes(), IMAGE_COMPRESSION)
+
+
+def iter_encoded_pages(pages, threads=None):
+    """
+    Yield (page, encoded image) for the papup pages in order, images are
+    compressed in a thread pool (zlib releases the GIL) while earlier pages
+    are being written. Only a few pages are in flight at any time.
+    """
+    if threads is None:
+        threads = os.cpu_count() or 1
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        for page in pages:
+            if len(pending) >= 2 * threads:
+                done = pending.popleft()
+                yield done[0], done[1].result()
+            pending.append((page, pool.submit(encode_page_image, page.page_image)))
+        while pending:
+            done = pending.popleft()
+            yield done[0], done[1].result()
+
+
+def pdf_string(text):
+    return "(" + text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+
+class BitmapPdfWriter():
+    """
+    Minimal PDF writer for papup pages: legend lines in Courier (a standard
+    font, nothing embedded) above the page bitmap as a Flate compressed
+    1-bit image XObject. Objects are written to the file as soon as a page
+    is added, only their offsets are kept.
+    """
+    CATALOG = 1
+    PAGES = 2
+    FONT = 3
+
+    def __init__(self, f):
+        self.f = f
+        self.offsets = {}
+        self.page_refs = []
+        self.next_object = 4
+        self.pos = 0
+        self.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self.write_object(self.CATALOG, b"<< /Type /Catalog /Pages 2 0 R >>")
+        self.write_object(self.FONT, b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>")
+
+    def write(self, data):
+        self.f.write(data)
+        self.pos += len(data)
+
+    def write_object(self, num, body, stream=None):
+        self.offsets[num] = self.pos
+        self.write("{} 0 obj\n".format(num).encode("ascii") + body)
+        if stream is not None:
+            self.write(b"\nstream\n")
+            self.write(stream)
+            self.write(b"\nendstream")
+        self.write(b"\nendobj\n")
+
+    def new_object(self):
+        num = self.next_object
+        self.next_object += 1
+        return num
+
+    def add_page(self, legend, width, height, image):
+        """
+        Add a page with the legend lines and an image of width x height
+        pixels, given as Flate compressed 1-bit rows. A pixel is one point,
+        as with the platypus backend.
+        """
+        pw, ph = A4
+        image_num = self.new_object()
+        self.write_object(image_num, (
+            "<< /Type /XObject /Subtype /Image /Width {} /Height {} /ColorSpace /DeviceGray"
+            " /BitsPerComponent 1 /Filter /FlateDecode /Length {} >>"
+        ).format(width, height, len(image)).encode("ascii"), image)
+
+        y = ph - PAGE_MARGIN - LEGEND_LEADING
+        ops = ["BT /F1 {} Tf {} TL {:.2f} {:.2f} Td".format(
+            LEGEND_FONT_SIZE, LEGEND_LEADING, PAGE_MARGIN, y + LEGEND_LEADING - LEGEND_FONT_SIZE)]
+        for n, line in enumerate(legend):
+            ops.append(("" if n == 0 else "T* ") + pdf_string(line) + " Tj")
+        ops.append("ET")
+        y -= (len(legend) - 1) * LEGEND_LEADING + 4
+        ops.append("1 w 2 J {:.2f} {:.2f} m {:.2f} {:.2f} l S".format(
+            PAGE_MARGIN, y, pw - PAGE_MARGIN, y))
+        y -= 0.5 * cm + height
+        ops.append("q {} 0 0 {} {:.2f} {:.2f} cm /Im0 Do Q".format(
+            width, height, (pw - width) / 2, y))
+        content = zlib.compress("\n".join(ops).encode("latin-1"))
+        content_num = self.new_object()
+        self.write_object(content_num, "<< /Filter /FlateDecode /Length {} >>".format(
+            len(content)).encode("ascii"), content)
+
+        page_num = self.new_object()
+        self.write_object(page_num, (
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {:.2f} {:.2f}] /Contents {} 0 R"
+            " /Resources << /Font << /F1 3 0 R >> /XObject << /Im0 {} 0 R >> >> >>"
+        ).format(pw, ph, content_num, image_num).encode("ascii"))
+        self.page_refs.append(page_num)
+
+    def close(self):
+        """Write page tree, cross reference table and trailer."""
+        kids = " ".join("{} 0 R".format(n) for n in self.page_refs)
+        self.write_object(self.PAGES, "<< /Type /Pages /Kids [{}] /Count {} >>".format(
+            kids, len(self.page_refs)).encode("ascii"))
+        xref = self.pos
+        count = self.next_object
+        lines = ["xref", "0 {}".format(count), "0000000000 65535 f "]
+        lines += ["{:010d} 00000 n ".format(self.offsets[n]) for n in range(1, count)]
+        lines += ["trailer", "<< /Size {} /Root 1 0 R >>".format(count),
+                  "startxref", str(xref), "%%EOF", ""]
+        self.write("\n".join(lines).encode("ascii"))
+
+
+def build_pdf(file, name, backend="direct", threads=None):
+    """
+    Write the pages of file into PDF name. The "direct" backend embeds the
+    page bitmaps as 1-bit images, compressed in threads threads; "platypus"
+    lays the pages out with reportlab, going through PNG.
+    """
+    if backend == "platypus":
+        return build_pdf_platypus(file, name)
+    if backend != "direct":
+        raise ValueError("Invalid PDF backend: {}".format(backend))
+    write_pdf(file.pages, name, threads)
+
+
+def write_pdf(pages, name, threads=None):
+    """
+    Stream papup pages (any iterable, e.g. a generator rendering them on
+    demand) into PDF name with the direct backend. A page is released as
+    soon as it is written, so memory does not grow with the page count.
+    The "pdf.write" stage includes the time spent rendering lazy pages.
+    """
+    with open(name, "wb") as f, metrics.timer("pdf.write", pages=0) as counters:
+        writer = BitmapPdfWriter(f)
+        for page, image in iter_encoded_pages(pages, threads):
+            writer.add_page(page.page_legend, page.page_image.width, page.page_image.height, image)
+            counters["pages"] += 1
+        writer.close()
+        counters["bytes_out"] = f.tell()
+
+
+def build_pdf_platypus(file, name):
+    # platypus takes long to import and is not needed by the direct backend
+    from reportlab.lib.styles import ParagraphStyle
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image
+    from reportlab.platypus.flowables import HRFlowable, PageBreak
+
+    # parsing the TTF is expensive, register it once per process
+    if 'DejaVuSansMono' not in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.registerFont(TTFont('DejaVuSansMono', 'DejaVuSansMono.ttf'))
 
     doc = SimpleDocTemplate(name, pagesize=A4,
                             rightMargin=1 * cm, leftMargin=1 * cm,
@@ -1,20 +1,53 @@
+import concurrent.futures
+import json
+import os
 import re
+import sqlite3
+import time
+from hashlib import sha256
 
-from PIL import Image
-from pyzbar.pyzbar import decode
+from PIL import Image, ImageOps
+
+from papup import metrics
+from papup.geometry import A4, QR_PER_ROW, qr_grid
+from papup.papup_file import base45_decode
+
+# resolution pages are reduced to for scan_tiled, assuming they span the
+# width of an A4 sheet
+SCAN_DPI = 200
+# pixel rows of a QR column with less dark pixels are not part of a code
+DARK_ROW_FRACTION = 0.1
+
+
+def decode(img):
+    """pyzbar's decode, imported on first use, as it needs the zbar library."""
+    from pyzbar.pyzbar import decode as zbar_decode
+    return zbar_decode(img)
 
 
 class Papdown:
+    """
+    Parts of one file as they are scanned. All parts but the last have the
+    same size, so they go straight to their final offset in a buffer that
+    is allocated once, received holds a flag for every part.
+    """
+
     def __init__(self, ident):
         self.ident = ident
-        self.pud = {}
         self.pud_count = 0
+        self.part_size = None
+        self.buffer = None
+        self.last_part = None
+        self.received = bytearray()
         self.pud_re = re.compile(rf"^PUD:{self.ident}:(\d+)/(\d+):([0-9A-F]+)$")
+        self.pue_re = re.compile(rf"^PUE:{self.ident}:(\d+)/(\d+):([0-9A-Z $%*+\-./:]+)$")
         self.pum = {}
         self.pum_count = 0
         self.pum_re = re.compile(rf"^PUM:{self.ident}:(\d+)/(\d+):(.+)$")
 
     def read_pum(self, n, total, data):
+        total = int(total)
+        n = int(n)
         if self.pum_count == 0:
             self.pum_count = total
         elif self.pum_count != total:
@@ -32,15 +65,28 @@ class Papdown:
         n = int(n)
         if self.pud_count == 0:
             self.pud_count = total
+            self.received = bytearray(total)
         elif self.pud_count != total:
             print("Conflicting PUD count")
             return
-        if n in self.pud:
-            if self.pud[n] != data:
+        if not 1 <= n <= total:
+            print("Invalid PUD number")
+            return
+        if self.received[n - 1]:
+            if self.get_part(n) != data:
                 print("Conflicting PUD content")
-                return
+            return
+        if n == total:
+            self.last_part = data
         else:
-            self.pud[n] = data
+            if self.part_size is None:
+                self.part_size = len(data)
+                self.buffer = bytearray(self.part_size * (total - 1))
+            elif len(data) != self.part_size:
+                print("Conflicting PUD size")
+                return
+            self.buffer[(n - 1) * self.part_size:n * self.part_size] = data
+        self.received[n - 1] = 1
 
     def read_code(self, data):
         m = self.pum_re.match(data)
@@ -49,21 +95,366 @@ class Papdown:
             return
         m = self.pud_re.match(data)
         if m:
-            self.read_pud(*m.groups())
+            n, total, part = m.groups()
+            try:
+                part = bytes.fromhex(part)
+            except ValueError:
+                print("Invalid PUD content")
+                return
+            self.read_pud(n, total, part)
+            return
+        m = self.pue_re.match(data)
+        if m:
+            n, total, part = m.groups()
+            try:
+                part = base45_decode(part)
+            except ValueError:
+                print("Invalid PUE content")
+                return
+            self.read_pud(n, total, part)
             return
 
+    def get_meta(self):
+        """File header from the PUM codes, None until all of them are read."""
+        if self.pum_count == 0 or len(self.pum) < self.pum_count:
+            return None
+        try:
+            return json.loads("".join(self.pum[n] for n in range(1, self.pum_count + 1)))
+        except ValueError:
+            print("Invalid PUM content")
+            return None
+
+    def get_part(self, n):
+        if n == self.pud_count:
+            return self.last_part
+        return bytes(self.buffer[(n - 1) * self.part_size:n * self.part_size])
+
+    def file_name(self):
+        """
+        Name to restore the file to: the name from the PUM header without
+        any directories, the ident until that is read or if it is unusable.
+        """
+        meta = self.get_meta()
+        name = str(meta.get("name") or "") if meta else ""
+        name = os.path.basename(name.replace("\\", "/"))
+        name = "".join(c for c in name if c >= " ").strip()
+        if name in ("", ".", ".."):
+            return self.ident
+        return name
+
+    def part_offset(self, n, meta=None):
+        """
+        Offset of part n in the file, None if it is not known yet: that of the
+        last part needs the size of the other parts or the PUM header meta.
+        """
+        if self.part_size is not None or n == 1:
+            return (n - 1) * (self.part_size or 0)
+        if n == self.pud_count and meta and self.last_part is not None:
+            return meta["size"] - len(self.last_part)
+        return None
+
+    def missing_parts(self):
+        """Numbers of all parts not read yet (all of them if none was read)."""
+        if not self.pud_count:
+            meta = self.get_meta()
+            return list(range(1, meta["parts"] + 1)) if meta else []
+        return [n + 1 for n, flag in enumerate(self.received) if not flag]
+
     def get_data(self):
-        data = b""
-        for n in range(1, self.pud_count + 1):
-            part = self.pud[n]
-            data += bytearray.fromhex(part)
-        return data
+        if self.missing_parts():
+            raise ValueError("Missing parts: {}".format(self.missing_parts()))
+        return bytes(self.buffer or b"") + (self.last_part or b"")
+
+    def write_to(self, f):
+        """
+        Write all parts read so far to their offsets in the seekable file f,
+        which is preallocated to the full size first, so missing parts are
+        left as holes to be filled later. A last part whose offset is not
+        known yet (see part_offset) is left out as well. Returns True if the file is complete
+        and matches the sha256 of the PUM header, False if it does not match,
+        None if that cannot be checked yet.
+        """
+        meta = self.get_meta()
+        if meta:
+            size = meta["size"]
+        elif self.part_size is not None or self.pud_count == 1:
+            size = (self.pud_count - 1) * (self.part_size or 0) + len(self.last_part or b"")
+        else:
+            # nothing but the last part, which cannot be placed yet
+            size = 0
+        with metrics.timer("restore.write", bytes_out=0) as counters:
+            f.truncate(size)
+            digest = sha256()
+            for n in range(1, self.pud_count + 1):
+                offset = self.part_offset(n, meta)
+                if not self.received[n - 1] or offset is None:
+                    digest = None
+                    continue
+                part = self.get_part(n)
+                f.seek(offset)
+                f.write(part)
+                counters["bytes_out"] += len(part)
+                if digest is not None:
+                    digest.update(part)
+        if not meta or not self.pud_count or digest is None:
+            return None
+        return digest.hexdigest() == meta["sha256"]
+
+
+class PageScan:
+    """Codes found on one scanned page and the time it took to decode it."""
+
+    def __init__(self, name, codes, seconds):
+        self.name = name
+        self.codes = codes
+        self.seconds = seconds
+
+    def __repr__(self):
+        return "<PageScan {} codes={} {:.3f}s>".format(self.name, len(self.codes), self.seconds)
+
+
+def iter_scan_pages(source):
+    """
+    Pages to scan from source: a directory (all image files in it, sorted by
+    name), the path of an image file (every frame of multi-page TIFFs), a PIL
+    image or a list of any of these. Pages are yielded as (name, path, frame)
+    for files and (name, image, None) for PIL images.
+    """
+    if isinstance(source, (list, tuple)):
+        for item in source:
+            yield from iter_scan_pages(item)
+    elif isinstance(source, Image.Image):
+        yield getattr(source, "filename", "") or repr(source), source, None
+    elif os.path.isdir(source):
+        extensions = Image.registered_extensions()
+        for name in sorted(os.listdir(source)):
+            path = os.path.join(source, name)
+            if os.path.splitext(name)[1].lower() in extensions and os.path.isfile(path):
+                yield from iter_scan_pages(path)
+    else:
+        with Image.open(source) as img:
+            frames = getattr(img, "n_frames", 1)
+        if frames == 1:
+            yield source, source, None
+        else:
+            for frame in range(frames):
+                yield "{}[{}]".format(source, frame), source, frame
+
+
+def scan_page(page):
+    """Decode the QR codes of one page from iter_scan_pages, returns a PageScan."""
+    name, img, frame = page
+    t0 = time.perf_counter()
+    if isinstance(img, Image.Image):
+        codes = decode(img)
+    else:
+        with Image.open(img) as im:
+            if frame is not None:
+                im.seek(frame)
+            codes = decode(im)
+    codes = [d.data.decode() if type(d.data) == bytes else d.data for d in codes]
+    return PageScan(name, codes, time.perf_counter() - t0)
+
+
+def load_scan(page, dpi=SCAN_DPI):
+    """
+    Greyscale image of a page from iter_scan_pages at about dpi (None for
+    full resolution). JPEG files are decoded at reduced size in draft mode,
+    other images are reduced by an integer factor.
+    """
+    name, img, frame = page
+    width = round(A4[0] / 72 * dpi) if dpi else None
+    if isinstance(img, Image.Image):
+        return reduce_scan(img, width)
+    # closed right away, convert leaves a loaded copy
+    with Image.open(img) as im:
+        if frame is not None:
+            im.seek(frame)
+        elif width and im.width > width:
+            # only does anything for JPEG, scales by 1/2, 1/4 or 1/8
+            im.draft("L", (width, round(im.height * width / im.width)))
+        return reduce_scan(im, width)
+
+
+def reduce_scan(img, width):
+    img = img.convert("L")
+    if width and img.width >= 2 * width:
+        img = img.reduce(img.width // width)
+    return img
+
+
+def binarize(img):
+    """Black and white ("L" with 0 and 255 only) with Otsu's threshold."""
+    hist = img.histogram()
+    total = sum(hist)
+    sum_all = sum(v * h for v, h in enumerate(hist))
+    best = 0
+    threshold = 127
+    w0 = s0 = 0
+    for v, h in enumerate(hist):
+        w0 += h
+        s0 += v * h
+        w1 = total - w0
+        if w0 == 0 or w1 == 0:
+            continue
+        var = w0 * w1 * (s0 / w0 - (sum_all - s0) / w1) ** 2
+        if var > best:
+            best = var
+            threshold = v
+    return img.point([0 if v <= threshold else 255 for v in range(256)])
+
+
+def find_qr_cells(img):
+    """
+    Boxes (left, upper, right, lower) of the QR codes on a binarized page.
+    Columns come from the PapupDocument grid, codes in a column are the runs
+    of rows that have enough dark pixels and are at least half a code high.
+    """
+    scale = img.width / A4[0]
+    x0, pitch, qw = qr_grid()
+    width = round(qw * scale)
+    # half the space between two columns
+    margin = round((pitch - qw) / 2 * scale)
+    light = 255 * (1 - DARK_ROW_FRACTION)
+    boxes = []
+    for col in range(QR_PER_ROW):
+        left = round((x0 + col * pitch) * scale)
+        # mean of every pixel row of the column
+        rows = img.crop((left, 0, left + width, img.height)).resize((1, img.height), Image.BOX).tobytes()
+        start = None
+        for y, v in enumerate(rows + b"\xff"):
+            if v < light:
+                if start is None:
+                    start = y
+            elif start is not None:
+                if y - start >= width // 2:
+                    boxes.append((max(0, left - margin), max(0, start - margin),
+                                  min(img.width, left + width + margin), min(img.height, y + margin)))
+                start = None
+    return boxes
+
+
+def crop_cell(img, box):
+    """Single QR code cut from img, with a white quiet zone added around it."""
+    cell = img.crop(box)
+    return ImageOps.expand(cell, border=max(4, cell.width // 8), fill=255)
+
+
+def decode_cell(img):
+    return [d.data.decode() if type(d.data) == bytes else d.data for d in decode(img)]
+
+
+def page_digest(page, file_digests=None):
+    """
+    sha256 of the content of a page from iter_scan_pages: file content and
+    frame number for files, pixels for PIL images. file_digests caches the
+    digests of whole files, for the frames of multi-page files.
+    """
+    name, img, frame = page
+    if isinstance(img, Image.Image):
+        digest = sha256("{} {}x{}:".format(img.mode, *img.size).encode())
+        digest.update(img.tobytes())
+        return digest.hexdigest()
+    if file_digests is None or img not in file_digests:
+        digest = sha256()
+        with open(img, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        if file_digests is None:
+            file_digests = {}
+        file_digests[img] = digest.hexdigest()
+    if frame is None:
+        return file_digests[img]
+    return "{}[{}]".format(file_digests[img], frame)
+
+
+class ScanSession:
+    """
+    sqlite database of a Scanner: all codes read, by ident, and the digests
+    of all pages scanned, so a scan can be resumed or extended with more
+    pages later on.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS codes ("
+                            "ident TEXT NOT NULL, code TEXT NOT NULL, PRIMARY KEY (ident, code))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS pages ("
+                            "digest TEXT PRIMARY KEY, name TEXT, codes INTEGER, scanned REAL)")
+
+    def close(self):
+        self.db.close()
+
+    def has_page(self, digest):
+        return self.db.execute("SELECT 1 FROM pages WHERE digest = ?", (digest,)).fetchone() is not None
+
+    def add_page(self, digest, name, codes):
+        """Record a scanned page and its codes in a single transaction."""
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO codes (ident, code) VALUES (?, ?)",
+                                [(m.group(1), code) for code in codes
+                                 for m in [Scanner.MATCH.match(code)] if m])
+            self.db.execute("INSERT OR REPLACE INTO pages (digest, name, codes, scanned) VALUES (?, ?, ?, ?)",
+                            (digest, name, len(codes), time.time()))
+
+    def iter_codes(self, ident=None):
+        if ident is None:
+            cursor = self.db.execute("SELECT code FROM codes ORDER BY ident")
+        else:
+            cursor = self.db.execute("SELECT code FROM codes WHERE ident = ?", (ident,))
+        for code, in cursor:
+            yield code
+
+
+class Restored:
+    """
+    Outcome of Scanner.restore for one file: the path, whether it was
+    written (not if it existed), the part numbers still missing and
+    verified, see Papdown.write_to.
+    """
+
+    def __init__(self, ident, path, missing, verified, written=True):
+        self.ident = ident
+        self.path = path
+        self.missing = missing
+        self.verified = verified
+        self.written = written
+
+    @property
+    def status(self):
+        if not self.written:
+            return "exists, not overwritten"
+        if self.missing:
+            return "missing parts {}".format(self.missing)
+        if self.verified is False:
+            return "sha256 mismatch"
+        if self.verified:
+            return "sha256 ok"
+        return "not verified"
+
+    def __repr__(self):
+        return "<Restored {} {}: {}>".format(self.ident, self.path, self.status)
+
 
 class Scanner:
-    MATCH = re.compile(r"^PU[DM]:([0-9A-Z]+):")
+    MATCH = re.compile(r"^PU[DEM]:([0-9A-Z]+):")
 
-    def __init__(self):
+    def __init__(self, session=None):
+        """
+        session is an optional ScanSession: codes stored in it are read
+        right away, and pages already in it are skipped by scan_batch and
+        scan_tiled.
+        """
         self.store = {}
+        self.session = session
+        # pages of the last scan_batch or scan_tiled skipped as already in
+        # the session
+        self.skipped = 0
+        if session is not None:
+            for code in session.iter_codes():
+                self.read_code(code)
 
     def read_code(self, data):
         if type(data) == bytes:
@@ -78,21 +469,120 @@ class Scanner:
 
     def dump(self):
         for k, v in self.store.items():
-            print(k, v.pum, v.pud)
+            print(k, v.pum, "{}/{} parts".format(v.pud_count - len(v.missing_parts()), v.pud_count))
 
-    def restore(self):
+    def restore(self, directory=".", overwrite=False):
+        """
+        Write every file into directory under its Papdown.file_name, part by
+        part, and verify it. Names used by more than one file get the ident
+        as a prefix. Existing files are left alone unless overwrite is set,
+        e.g. to complete them from a resumed session. Returns a Restored for
+        each ident.
+        """
+        results = {}
+        names = set()
         for k, v in self.store.items():
-            d = v.get_data()
-            with open(f"{k}.jpg", "wb") as f:
-                f.write(d)
+            name = v.file_name()
+            if name in names:
+                name = "{}-{}".format(k, name)
+            names.add(name)
+            path = os.path.join(directory, name)
+            if not overwrite and os.path.exists(path):
+                results[k] = Restored(k, path, v.missing_parts(), None, written=False)
+                continue
+            with open(path, "wb") as f:
+                verified = v.write_to(f)
+            results[k] = Restored(k, path, v.missing_parts(), verified)
+        return results
 
     def scan(self, img):
-        for d in decode(img):
+        with metrics.timer("scan.decode", pages=1) as counters:
+            codes = decode(img)
+            counters["qr_symbols"] = len(codes)
+        for d in codes:
             self.read_code(d.data)
 
+    def scan_batch(self, source, processes=None):
+        """
+        Scan all pages of source (see iter_scan_pages) in a pool of processes
+        worker processes (default: one per CPU) and read their codes into the
+        store, in page order. Returns a PageScan for every page scanned.
+        """
+        pages, digests = self._pages_to_scan(source)
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if processes > 1 and len(pages) > 1:
+            with concurrent.futures.ProcessPoolExecutor(min(processes, len(pages))) as pool:
+                results = list(self._read_scans(pool.map(scan_page, pages), digests))
+        else:
+            results = list(self._read_scans(map(scan_page, pages), digests))
+        return results
+
+    def scan_tiled(self, source, processes=None, dpi=SCAN_DPI):
+        """
+        Like scan_batch, but every page is reduced to dpi, the QR codes are
+        located on the known grid in a binarized copy and decoded one by one
+        from the greyscale page in a pool of processes worker processes.
+        Cells that do not decode are retried from the full resolution page,
+        the whole page is only decoded if no cells were found at all.
+        """
+        pages, digests = self._pages_to_scan(source)
+        if processes is None:
+            processes = os.cpu_count() or 1
+        pool = concurrent.futures.ProcessPoolExecutor(processes) if processes > 1 else None
+        run = pool.map if pool else map
+        try:
+            return list(self._read_scans(self._iter_tiled(pages, run, dpi), digests))
+        finally:
+            if pool:
+                pool.shutdown()
+
+    def _iter_tiled(self, pages, run, dpi):
+        for page in pages:
+            t0 = time.perf_counter()
+            img = load_scan(page, dpi)
+            # decoders do better with their own thresholding on the cells
+            boxes = find_qr_cells(binarize(img))
+            found = list(run(decode_cell, [crop_cell(img, box) for box in boxes]))
+            failed = [box for box, codes in zip(boxes, found) if not codes]
+            if failed or not boxes:
+                full = load_scan(page, dpi=None)
+                scale = full.width / img.width
+                if boxes:
+                    cells = [crop_cell(full, tuple(round(c * scale) for c in box)) for box in failed]
+                else:
+                    cells = [full]
+                found += run(decode_cell, cells)
+            codes = [code for cell in found for code in cell]
+            yield PageScan(page[0], codes, time.perf_counter() - t0)
+
+    def _pages_to_scan(self, source):
+        """Pages of source and their digests, without those in the session."""
+        pages = list(iter_scan_pages(source))
+        self.skipped = 0
+        if self.session is None:
+            return pages, [None] * len(pages)
+        file_digests = {}
+        digests = [page_digest(page, file_digests) for page in pages]
+        todo = [(page, digest) for page, digest in zip(pages, digests)
+                if not self.session.has_page(digest)]
+        self.skipped = len(pages) - len(todo)
+        return [page for page, _ in todo], [digest for _, digest in todo]
+
+    def _read_scans(self, scans, digests):
+        for scan, digest in zip(scans, digests):
+            for code in scan.codes:
+                self.read_code(code)
+            if self.session is not None:
+                self.session.add_page(digest, scan.name, scan.codes)
+            # decoded in workers, so the time is reported from here
+            metrics.record("scan.decode", scan.seconds, pages=1, qr_symbols=len(scan.codes))
+            yield scan
+
 
-img = Image.open('qrdings.jpg')
-scanner = Scanner()
-scanner.scan(img)
-#scanner.dump()
-scanner.restore()
+if __name__ == "__main__":
+    img = Image.open('qrdings.jpg')
+    scanner = Scanner()
+    scanner.scan(img)
+    #scanner.dump()
+    scanner.restore()
@@ -0,0 +1,378 @@
+"""
+Reed-Solomon coding over GF(2^8), compatible with unireedsolomon's RSCoder
+(generator 3, primitive polynomial 0x11b, first consecutive root 1).
+
+All codewords of a buffer are encoded together: the buffer is split into
+columns (byte i of every codeword) and the LFSR runs over whole columns,
+using bytes.translate with precomputed multiplication tables for the
+multiplications in the field.
+
+Decoding re-encodes all messages the same way and only the codewords whose
+parity does not match go through Berlekamp-Massey, Chien search and Forney,
+optionally spread over a process pool.
+"""
+
+import concurrent.futures
+import functools
+import os
+
+GF_GENERATOR = 3
+GF_PRIM = 0x11b
+
+# antilog table is doubled, so that exponent sums never need a modulo
+GF_EXP = bytearray(512)
+GF_LOG = bytearray(256)
+
+
+def _init_tables():
+    x = 1
+    for i in range(255):
+        GF_EXP[i] = x
+        GF_LOG[x] = i
+        # multiply by generator 3 == x * 2 ^ x
+        x2 = x << 1
+        if x2 & 0x100:
+            x2 ^= GF_PRIM
+        x = x2 ^ x
+    for i in range(255, 512):
+        GF_EXP[i] = GF_EXP[i - 255]
+
+
+_init_tables()
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+def gf_div(a, b):
+    if b == 0:
+        raise ZeroDivisionError()
+    if a == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + 255 - GF_LOG[b]]
+
+
+def gf_pow(x, power):
+    return GF_EXP[(GF_LOG[x] * power) % 255]
+
+
+def gf_inverse(x):
+    return GF_EXP[255 - GF_LOG[x]]
+
+
+@functools.lru_cache(maxsize=None)
+def gf_mul_table(c):
+    """Translation table that multiplies every byte by constant c."""
+    return bytes(gf_mul(c, x) for x in range(256))
+
+
+def gf_poly_mul(p, q):
+    r = [0] * (len(p) + len(q) - 1)
+    for i, a in enumerate(p):
+        for j, b in enumerate(q):
+            r[i + j] ^= gf_mul(a, b)
+    return r
+
+
+def gf_poly_scale(p, x):
+    return [gf_mul(c, x) for c in p]
+
+
+def gf_poly_add(p, q):
+    r = [0] * max(len(p), len(q))
+    for i, c in enumerate(p):
+        r[i + len(r) - len(p)] = c
+    for i, c in enumerate(q):
+        r[i + len(r) - len(q)] ^= c
+    return r
+
+
+def gf_poly_eval(p, x):
+    """Evaluate polynomial p (highest degree first) at x (Horner)."""
+    y = p[0]
+    for c in p[1:]:
+        y = gf_mul(y, x) ^ c
+    return y
+
+
+class ReedSolomonError(ValueError):
+    pass
+
+
+class RSDecodeReport:
+    """
+    Correction statistics of a decoded buffer: corrected maps the index of
+    every repaired codeword to the number of bytes fixed in it, failed lists
+    the codewords that could not be repaired (their data is left as read).
+    """
+
+    def __init__(self, codewords):
+        self.codewords = codewords
+        self.corrected = {}
+        self.failed = []
+
+    @property
+    def clean(self):
+        return not self.corrected and not self.failed
+
+    @property
+    def corrected_bytes(self):
+        return sum(self.corrected.values())
+
+    def __repr__(self):
+        return "<RSDecodeReport codewords={} corrected={} bytes={} failed={}>".format(
+            self.codewords, len(self.corrected), self.corrected_bytes, len(self.failed))
+
+
+class RSCodec:
+    """
+    Systematic RS(n, k) codec: codewords are the k message bytes followed by
+    n - k parity bytes.
+    """
+
+    def __init__(self, n, k):
+        if not 0 < k < n <= 255:
+            raise ValueError("Invalid RS code: ({}, {})".format(n, k))
+        self.n = n
+        self.k = k
+        self.nsym = n - k
+        # g(x) = (x - a^1)(x - a^2)...(x - a^(n-k)), highest degree first
+        g = [1]
+        for i in range(1, self.nsym + 1):
+            g = gf_poly_mul(g, [1, GF_EXP[i]])
+        self.generator = g
+        self.generator_tables = [gf_mul_table(c) for c in g[1:]]
+        # multiply by a^(i+1), for Horner evaluation of the syndromes
+        self.syndrome_tables = [gf_mul_table(GF_EXP[i]) for i in range(1, self.nsym + 1)]
+
+    def _parity(self, data, count, stride):
+        """
+        Parity columns (as ints) for count messages, message byte i of all
+        codewords is data[i::stride].
+        """
+        tables = self.generator_tables
+        parity = [0] * self.nsym
+        for i in range(self.k):
+            feedback = int.from_bytes(data[i::stride], "big") ^ parity[0]
+            feedback = feedback.to_bytes(count, "big")
+            parity = [p ^ int.from_bytes(feedback.translate(t), "big")
+                      for p, t in zip(parity[1:] + [0], tables)]
+        return parity
+
+    def encode(self, data):
+        """
+        Encode data, whose length must be a multiple of k, into len(data) / k
+        codewords of n bytes each.
+        """
+        n, k = self.n, self.k
+        if len(data) % k:
+            raise ValueError("Data length {} is no multiple of {}".format(len(data), k))
+        count = len(data) // k
+        if count == 0:
+            return b""
+        data = bytes(data)
+        parity = self._parity(data, count, k)
+        out = bytearray(count * n)
+        for i in range(k):
+            out[i::n] = data[i::k]
+        for i, p in enumerate(parity):
+            out[k + i::n] = p.to_bytes(count, "big")
+        return bytes(out)
+
+    def find_damaged(self, data):
+        """Indices of all codewords in data whose parity does not match."""
+        n, k = self.n, self.k
+        count = len(data) // n
+        parity = self._parity(data, count, n)
+        diff = 0
+        for i, p in enumerate(parity):
+            diff |= p ^ int.from_bytes(data[k + i::n], "big")
+        if diff == 0:
+            return []
+        return [i for i, b in enumerate(diff.to_bytes(count, "big")) if b]
+
+    def messages(self, data):
+        """The message bytes of all codewords in data, as read."""
+        n, k = self.n, self.k
+        out = bytearray(len(data) // n * k)
+        for i in range(k):
+            out[i::k] = data[i::n]
+        return out
+
+    def damaged_codewords(self, data, damaged, erasures=None):
+        """(codeword, erasures) of the codewords damaged in data, for repair()."""
+        n = self.n
+        erased = {}
+        for offset in erasures or ():
+            erased.setdefault(offset // n, []).append(offset % n)
+        return [(bytes(data[i * n:(i + 1) * n]), erased.get(i)) for i in damaged]
+
+    def repair(self, codewords, processes=None):
+        """
+        Decode (codeword, erasures) pairs, in a process pool of the given size
+        (default: one per CPU) if there are enough of them to be worth it.
+        Returns (message, corrected bytes) for each, message is None for
+        codewords that cannot be repaired.
+        """
+        jobs = [(self.n, self.k, codeword, erasures) for codeword, erasures in codewords]
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if processes > 1 and len(jobs) >= PARALLEL_DECODE_MIN:
+            with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+                return list(pool.map(_decode_codeword, jobs,
+                                     chunksize=max(1, len(jobs) // (processes * 4))))
+        return [_decode_codeword(job) for job in jobs]
+
+    def syndromes(self, codeword):
+        synd = [0]
+        for table in self.syndrome_tables:
+            y = 0
+            for c in codeword:
+                y = table[y] ^ c
+            synd.append(y)
+        return synd
+
+    def _forney_syndromes(self, synd, erasures):
+        """Syndromes with the known erasures taken out, for Berlekamp-Massey."""
+        fsynd = synd[1:]
+        for p in erasures:
+            x = GF_EXP[self.n - 1 - p]
+            for j in range(len(fsynd) - 1):
+                fsynd[j] = gf_mul(fsynd[j], x) ^ fsynd[j + 1]
+        return fsynd
+
+    def _error_locator(self, fsynd, erase_count=0):
+        """Berlekamp-Massey"""
+        err_loc = [1]
+        old_loc = [1]
+        for i in range(self.nsym - erase_count):
+            delta = fsynd[i]
+            for j in range(1, len(err_loc)):
+                delta ^= gf_mul(err_loc[-(j + 1)], fsynd[i - j])
+            old_loc = old_loc + [0]
+            if delta != 0:
+                if len(old_loc) > len(err_loc):
+                    new_loc = gf_poly_scale(old_loc, delta)
+                    old_loc = gf_poly_scale(err_loc, gf_inverse(delta))
+                    err_loc = new_loc
+                err_loc = gf_poly_add(err_loc, gf_poly_scale(old_loc, delta))
+        while err_loc and err_loc[0] == 0:
+            del err_loc[0]
+        if (len(err_loc) - 1) * 2 + erase_count > self.nsym:
+            raise ReedSolomonError("Too many errors to correct")
+        return err_loc
+
+    def _error_positions(self, err_loc):
+        """Chien search"""
+        n = self.n
+        err_loc = err_loc[::-1]
+        positions = [n - 1 - i for i in range(n)
+                     if gf_poly_eval(err_loc, GF_EXP[i]) == 0]
+        if len(positions) != len(err_loc) - 1:
+            raise ReedSolomonError("Could not locate errors")
+        return positions
+
+    def _correct_errata(self, codeword, synd, positions):
+        """Forney, returns the number of bytes that actually changed"""
+        n = self.n
+        coef_pos = [n - 1 - p for p in positions]
+        # errata locator
+        loc = [1]
+        for p in coef_pos:
+            loc = gf_poly_mul(loc, [GF_EXP[p], 1])
+        # errata evaluator
+        rsynd = synd[::-1]
+        evaluator = gf_poly_mul(rsynd, loc)
+        evaluator = evaluator[len(evaluator) - len(loc):][::-1]
+        xs = [GF_EXP[p] for p in coef_pos]
+        changed = 0
+        for i, x in enumerate(xs):
+            x_inv = gf_inverse(x)
+            loc_prime = 1
+            for j, xj in enumerate(xs):
+                if j != i:
+                    loc_prime = gf_mul(loc_prime, 1 ^ gf_mul(x_inv, xj))
+            if loc_prime == 0:
+                raise ReedSolomonError("Could not correct errata")
+            y = gf_poly_eval(evaluator[::-1], x_inv)
+            magnitude = gf_div(y, loc_prime)
+            if magnitude:
+                codeword[positions[i]] ^= magnitude
+                changed += 1
+        return changed
+
+    def decode_codeword(self, codeword, erasures=None):
+        """
+        Correct a single codeword, returns the message and the number of
+        corrected bytes. erasures are positions in the codeword known to be
+        bad: each costs one parity byte instead of two for unknown errors.
+        If decoding with the erasures fails (e.g. more than n - k of them),
+        decoding is retried with unknown errors only.
+        """
+        if erasures:
+            erasures = sorted(set(erasures))
+            if len(erasures) <= self.nsym:
+                try:
+                    return self._decode_codeword(codeword, erasures)
+                except ReedSolomonError:
+                    pass
+        return self._decode_codeword(codeword, [])
+
+    def _decode_codeword(self, codeword, erasures):
+        codeword = bytearray(codeword)
+        synd = self.syndromes(codeword)
+        if max(synd) == 0:
+            return bytes(codeword[:self.k]), 0
+        fsynd = self._forney_syndromes(synd, erasures)
+        err_loc = self._error_locator(fsynd, len(erasures))
+        positions = self._error_positions(err_loc)
+        changed = self._correct_errata(codeword, synd, erasures + positions)
+        if max(self.syndromes(codeword)) != 0:
+            raise ReedSolomonError("Could not correct codeword")
+        return bytes(codeword[:self.k]), changed
+
+    def decode(self, data, erasures=None, processes=None):
+        """
+        Decode data made of complete codewords. Returns the messages and an
+        RSDecodeReport. Damaged codewords are repaired in a process pool of
+        the given size (default: one per CPU) if there are enough of them
+        to be worth it. erasures are offsets in data of bytes known to be
+        bad, e.g. from blocks that failed their CRC.
+        """
+        n, k = self.n, self.k
+        if len(data) % n:
+            raise ValueError("Data length {} is no multiple of {}".format(len(data), n))
+        report = RSDecodeReport(len(data) // n)
+        out = self.messages(data)
+        damaged = self.find_damaged(data)
+        if not damaged:
+            return bytes(out), report
+        results = self.repair(self.damaged_codewords(data, damaged, erasures), processes)
+        for i, (message, corrected) in zip(damaged, results):
+            if message is None:
+                report.failed.append(i)
+            else:
+                out[i * k:(i + 1) * k] = message
+                report.corrected[i] = corrected
+        return bytes(out), report
+
+
+# below this many damaged codewords decoding is done without a process pool
+PARALLEL_DECODE_MIN = 64
+
+
+def _decode_codeword(job):
+    n, k, codeword, erasures = job
+    try:
+        return get_codec(n, k).decode_codeword(codeword, erasures)
+    except ReedSolomonError:
+        return None, 0
+
+
+@functools.lru_cache(maxsize=None)
+def get_codec(n, k):
+    """Shared RSCodec for (n, k), tables are only built once."""
+    return RSCodec(n, k)
@@ -0,0 +1,48 @@
+import io
+import random
+
+import pytest
+
+from papup.payload import PAYLOAD_HEADER_SIZE, REDUNDANCY_CODES, RS_BATCH_CODEWORDS, PapupPayload
+
+BLOCK_PAYLOAD = 124
+
+
+def pack(content, redundancy):
+    pl = PapupPayload(redundancy=redundancy, compression=0)
+    out = io.BytesIO()
+    pl.pack_to(out, content)
+    return bytearray(out.getvalue())
+
+
+def unpack(data, erasures):
+    out = io.BytesIO()
+    PapupPayload().unpack_to(out, bytes(data), erasures=erasures)
+    return out.getvalue()
+
+
+def erase_block(data, start):
+    """Scramble a block as read back with a failed CRC, returns the erasures."""
+    for i in range(start, start + BLOCK_PAYLOAD):
+        data[i] ^= 0xff
+    return list(range(start, start + BLOCK_PAYLOAD))
+
+
+@pytest.mark.parametrize("codewords", [RS_BATCH_CODEWORDS + 2, 2 * RS_BATCH_CODEWORDS + 100])
+@pytest.mark.parametrize("where", ["head", "tail"])
+def test_lost_block_in_any_batch(codewords, where):
+    n, k = REDUNDANCY_CODES[1]
+    # payload fills exactly the given number of codewords (4 bytes of meta)
+    content = random.Random(codewords).randbytes(codewords * k - 4)
+    data = pack(content, 1)
+    assert len(data) == PAYLOAD_HEADER_SIZE + codewords * n
+    start = PAYLOAD_HEADER_SIZE + 100 if where == "head" else len(data) - BLOCK_PAYLOAD - 10
+    erasures = erase_block(data, start)
+    assert unpack(data, erasures) == content
+
+
+@pytest.mark.parametrize("size", [0, 1, 5000, 200000])
+@pytest.mark.parametrize("redundancy", sorted(REDUNDANCY_CODES))
+def test_round_trip(size, redundancy):
+    content = random.Random(size).randbytes(size)
+    assert unpack(pack(content, redundancy), []) == content